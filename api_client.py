@@ -1,20 +1,165 @@
 """
 API клиент для работы с Nebius API
 """
-import requests
+import asyncio
 import logging
-from typing import Optional
-from PIL import Image
-import io
-import base64
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from config import NEBUS_API_KEY, NEBUS_API_URL, API_TIMEOUT, IMAGE_MAX_SIZE, IMAGE_QUALITY
+import multiprocessing
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Dict, Any, Tuple, Callable
+import aiohttp
+import orjson
+from config import (
+    NEBUS_API_KEY, NEBUS_API_URL, API_TIMEOUT, API_MAX_CONNECTIONS, API_KEEPALIVE_TIMEOUT,
+    API_MODEL, API_FALLBACK_MODEL, API_PROMPT_CACHE_KEY, IMAGE_WORKERS,
+    SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_MODEL, SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_MAX_SIZE
+)
+from image_processing import prepare_image, warm_up as warm_up_image_worker
+from semantic_cache import SemanticCache, create_semantic_cache
 
 logger = logging.getLogger(__name__)
 
+# Статические части запросов сериализуются один раз при импорте,
+# на каждый вызов подставляется только динамическое поле
+API_MODELS = (API_MODEL, API_FALLBACK_MODEL) if API_FALLBACK_MODEL else (API_MODEL,)
+_DYNAMIC_FIELD = "__dynamic__"
+
+# Неизменные инструкции идут первыми, описание или изображение - последними:
+# сервер может переиспользовать KV-кэш общего префикса между запросами
+IMAGE_INSTRUCTION = "Проанализируй это изображение еды и определи примерное количество калорий. Ответь только числом калорий, без дополнительного текста."
+TEXT_INSTRUCTION = "Проанализируй описание еды от пользователя и определи примерное количество калорий. Ответь только числом калорий, без дополнительного текста."
+
+def _split_request_template(template: Dict[str, Any]) -> Tuple[bytes, bytes]:
+    """Сериализованный шаблон запроса, разрезанный по динамическому полю"""
+    if API_PROMPT_CACHE_KEY:
+        template = dict(template, prompt_cache_key=API_PROMPT_CACHE_KEY)
+    prefix, suffix = orjson.dumps(template).split(orjson.dumps(_DYNAMIC_FIELD))
+    return prefix, suffix
+
+def _image_request_template(model: str) -> Dict[str, Any]:
+    return {
+        "model": model,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": IMAGE_INSTRUCTION
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": _DYNAMIC_FIELD
+                        }
+                    }
+                ]
+            }
+        ],
+        "max_tokens": 50,
+        "temperature": 0.1
+    }
+
+def _text_request_template(model: str) -> Dict[str, Any]:
+    return {
+        "model": model,
+        "messages": [
+            {
+                "role": "system",
+                "content": TEXT_INSTRUCTION
+            },
+            {
+                "role": "user",
+                "content": _DYNAMIC_FIELD
+            }
+        ],
+        "max_tokens": 50,
+        "temperature": 0.1
+    }
+
+_IMAGE_REQUEST_TEMPLATES = {
+    model: _split_request_template(_image_request_template(model)) for model in API_MODELS
+}
+_TEXT_REQUEST_TEMPLATES = {
+    model: _split_request_template(_text_request_template(model)) for model in API_MODELS
+}
+
+# Ответ модели - короткое число: достаем его из тела без полного разбора JSON.
+# Совпадает только строка без escape-последовательностей, иначе разбираем orjson
+_CONTENT_PATTERN = re.compile(rb'"content"\s*:\s*"([^"\\]*)"')
+
+def _extract_content(payload: bytes) -> Optional[str]:
+    """Текст ответа модели из тела успешного ответа API"""
+    match = _CONTENT_PATTERN.search(payload)
+    if match is not None:
+        return match.group(1).decode().strip()
+    
+    payload = orjson.loads(payload)
+    if 'choices' in payload and len(payload['choices']) > 0:
+        return payload['choices'][0]['message']['content'].strip()
+    logger.error("Unexpected API response format: %s", payload)
+    return None
+
+# Повторы на временных ошибках сервера и обрывах соединения
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 0.5
+
+# Размыкатель цепи: после серии сбоев запросы временно не отправляются
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30  # секунд
+
+class CircuitOpenError(Exception):
+    """API временно недоступен, запрос не отправлялся"""
+
+class CircuitBreaker:
+    """Размыкатель цепи для соединения с API"""
+    
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        # Полуоткрытое состояние: после таймаута идет ровно один пробный запрос
+        self._trial_in_flight = False
+    
+    def allow_request(self) -> bool:
+        """Разрешен ли запрос (после таймаута пропускается один пробный запрос)"""
+        if self._opened_at is None:
+            return True
+        if self._trial_in_flight or time.monotonic() - self._opened_at < self.reset_timeout:
+            return False
+        self._trial_in_flight = True
+        return True
+    
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+    
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._trial_in_flight = False
+        if self._failures >= self.failure_threshold:
+            if self._opened_at is None:
+                logger.warning("API circuit opened after %d consecutive failures", self._failures)
+            self._opened_at = time.monotonic()
+    
+    @property
+    def half_open(self) -> bool:
+        """Идет пробный запрос после таймаута"""
+        return self._trial_in_flight
+    
+    def release_trial(self) -> None:
+        """Пробный запрос завершился без результата (отменен или другая ошибка):
+        следующий запрос после таймаута снова может стать пробным"""
+        self._trial_in_flight = False
+
 class NebiusAPIClient:
-    """Клиент для работы с Nebius API"""
+    """Асинхронный клиент для работы с Nebius API"""
     
     def __init__(self, api_key: str, api_url: str):
         self.api_key = api_key
@@ -23,146 +168,257 @@ class NebiusAPIClient:
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
+        self.completions_url = f"{api_url}chat/completions"
         
-        # Создаем оптимизированную сессию с retry логикой
-        self.session = requests.Session()
-        
-        # Настройка retry стратегии
-        retry_strategy = Retry(
-            total=3,
-            backoff_factor=1,
-            status_forcelist=[429, 500, 502, 503, 504],
-            allowed_methods=["POST"]
-        )
+        # Сессия создается лениво: aiohttp требует запущенный event loop
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._circuit = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
         
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.session.mount("http://", adapter)
-        self.session.mount("https://", adapter)
+        # Декодирование/масштабирование JPEG нагружает CPU: выносим из event loop и из-под GIL
+        self._image_pool: Optional[ProcessPoolExecutor] = None
         
-        # Устанавливаем таймауты
-        self.session.timeout = API_TIMEOUT
+        # Семантический кэш для похожих текстовых описаний (модель загружается в warm_up)
+        self._semantic_cache: Optional[SemanticCache] = None
+        self._semantic_cache_load: Optional[asyncio.Task] = None
+        if SEMANTIC_CACHE_ENABLED:
+            self._semantic_cache = create_semantic_cache(
+                SEMANTIC_CACHE_MODEL, SEMANTIC_CACHE_THRESHOLD,
+                SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_MAX_SIZE
+            )
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Общая сессия с пулом соединений для всех запросов"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(
+                    limit=API_MAX_CONNECTIONS,
+                    keepalive_timeout=API_KEEPALIVE_TIMEOUT,
+                    ttl_dns_cache=300
+                ),
+                timeout=aiohttp.ClientTimeout(total=API_TIMEOUT)
+            )
+        return self._session
+    
+    async def close(self) -> None:
+        """Закрытие сессии и пула процессов при остановке бота"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self._image_pool is not None:
+            self._image_pool.shutdown(wait=False)
+            self._image_pool = None
+    
+    def _get_image_pool(self) -> ProcessPoolExecutor:
+        if self._image_pool is None:
+            # fork из процесса с потоками (to_thread, запись истории, torch) может
+            # оставить дочерний процесс с захваченной блокировкой: процессы запускает forkserver
+            # (каждый из них импортирует главный модуль, поэтому импорт bot не трогает базу)
+            self._image_pool = ProcessPoolExecutor(
+                max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("forkserver")
+            )
+        return self._image_pool
     
-    def _prepare_image(self, image_data: bytes) -> str:
-        """Подготовка изображения для API"""
+    async def warm_up(self) -> None:
+        """Прогрев при запуске: процессы пула и TLS-соединение с API готовы до первого пользователя"""
+        loop = asyncio.get_running_loop()
         try:
-            # Открываем изображение
-            image = Image.open(io.BytesIO(image_data))
-            
-            # Оптимизируем размер изображения для API
-            image.thumbnail(IMAGE_MAX_SIZE, Image.Resampling.LANCZOS)
-            
-            # Конвертируем в base64
-            buffered = io.BytesIO()
-            image.save(buffered, format="JPEG", quality=IMAGE_QUALITY)
-            img_base64 = base64.b64encode(buffered.getvalue()).decode()
-            
-            return img_base64
+            await loop.run_in_executor(self._get_image_pool(), warm_up_image_worker)
         except Exception as e:
-            logger.error(f"Error preparing image: {e}")
+            logger.warning("Image worker warm-up failed: %s", e)
+        
+        # Ответ не важен: запрос только открывает соединение и оставляет его в пуле
+        try:
+            session = self._get_session()
+            async with session.head(self.api_url, timeout=aiohttp.ClientTimeout(total=5)):
+                pass
+        except Exception as e:
+            logger.warning("API connection warm-up failed: %s", e)
+        
+        # Модель эмбеддингов грузится несколько секунд: бот отвечает сразу,
+        # а кэш начинает работать, когда загрузка закончится
+        if self._semantic_cache is not None and self._semantic_cache_load is None:
+            self._semantic_cache_load = asyncio.create_task(asyncio.to_thread(self._semantic_cache.load))
+    
+    async def _prepare_image(self, image_data: bytes) -> bytes:
+        """Подготовка изображения в пуле процессов"""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._get_image_pool(), prepare_image, image_data)
+        except BrokenProcessPool:
+            # Упавший процесс ломает весь пул: пересоздадим его при следующем вызове
+            self._image_pool = None
+            raise
+    
+    @staticmethod
+    async def _error_body(response: aiohttp.ClientResponse) -> str:
+        """Тело ответа с ошибкой нужно только для лога: не декодируем, если лог отключен"""
+        if not logger.isEnabledFor(logging.ERROR):
+            return ""
+        return await response.text()
+    
+    async def _post_completion(self, body: bytes) -> Tuple[int, Any]:
+        """Запрос к chat/completions с экспоненциальными повторами и размыкателем цепи"""
+        if not self._circuit.allow_request():
+            raise CircuitOpenError("Nebius API circuit is open")
+        
+        # Пробный запрос полуоткрытой цепи должен закончиться успехом или сбоем,
+        # иначе (отмена проигравшей модели, другая ошибка) цепь не пропустит следующий
+        is_trial = self._circuit.half_open
+        try:
+            session = self._get_session()
+            attempt = 0
+            while True:
+                try:
+                    async with session.post(self.completions_url, data=body) as response:
+                        if response.status == 200:
+                            payload = await response.read()
+                            self._circuit.record_success()
+                            return response.status, payload
+                        if response.status not in RETRY_STATUSES:
+                            self._circuit.record_success()
+                            return response.status, await self._error_body(response)
+                        if attempt >= MAX_RETRIES:
+                            self._circuit.record_failure()
+                            return response.status, await self._error_body(response)
+                        reason = f"status {response.status}"
+                except aiohttp.ClientConnectionError as e:
+                    if attempt >= MAX_RETRIES:
+                        self._circuit.record_failure()
+                        raise
+                    reason = f"connection error {e}"
+                except asyncio.TimeoutError:
+                    # Таймаут не повторяем: пользователь и так ждал API_TIMEOUT секунд
+                    self._circuit.record_failure()
+                    raise
+                
+                # Повтор переиспользует уже открытое соединение из пула
+                delay = RETRY_BACKOFF_FACTOR * (2 ** attempt)
+                attempt += 1
+                logger.warning("API request failed (%s), retry %d/%d in %ss", reason, attempt, MAX_RETRIES, delay)
+                await asyncio.sleep(delay)
+        except BaseException:
+            if is_trial:
+                self._circuit.release_trial()
             raise
     
-    def analyze_image(self, image_data: bytes) -> str:
-        """Анализ изображения еды через Nebius API"""
+    async def _request_calories(self, build_body: Callable[[str], bytes],
+                                error_message: str) -> Tuple[bool, str]:
+        """Запрос к моделям из API_MODELS параллельно; берется первый успешный ответ"""
+        async def call(model: str) -> Tuple[bool, str]:
+            status, payload = await self._post_completion(build_body(model))
+            return self._parse_completion(status, payload, error_message)
+        
+        if len(API_MODELS) == 1:
+            return await call(API_MODELS[0])
+        
+        tasks = [asyncio.ensure_future(call(model)) for model in API_MODELS]
+        first_failure: Optional[Tuple[bool, str]] = None
+        first_error: Optional[BaseException] = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    success, result = await next_done
+                except Exception as e:
+                    first_error = first_error or e
+                    continue
+                if success:
+                    return success, result
+                first_failure = first_failure or (success, result)
+        finally:
+            # Отменяем проигравшие запросы
+            for task in tasks:
+                task.cancel()
+        
+        if first_failure is not None:
+            return first_failure
+        raise first_error
+    
+    def _parse_completion(self, status: int, payload: Any, error_message: str) -> Tuple[bool, str]:
+        """Извлечение количества калорий из ответа API (флаг успеха, текст ответа)"""
+        if status == 200:
+            calories = _extract_content(payload)
+            if calories is not None:
+                return True, f"Примерное количество калорий: {calories}"
+            else:
+                return False, "Извините, не удалось получить корректный ответ от API. Попробуйте еще раз."
+        else:
+            logger.error("API Error: %s - %s", status, payload)
+            return False, error_message
+    
+    async def analyze_image(self, image_data: bytes) -> str:
+        """Анализ изображения еды через Nebius API (кэш ответов - в bot.cached_analysis)"""
         try:
             # Подготавливаем изображение
-            img_base64 = self._prepare_image(image_data)
+            image_url = await self._prepare_image(image_data)
             
-            # Данные для запроса
-            data = {
-                "model": "Qwen/Qwen2.5-VL-72B-Instruct",
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Проанализируй это изображение еды и определи примерное количество калорий. Ответь только числом калорий, без дополнительного текста."
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{img_base64}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                "max_tokens": 50,
-                "temperature": 0.1
-            }
+            # Тело запроса: data URL (ASCII без экранирования) вклеивается в готовый шаблон
+            def build_body(model: str) -> bytes:
+                prefix, suffix = _IMAGE_REQUEST_TEMPLATES[model]
+                return b"".join((prefix, b'"', image_url, b'"', suffix))
             
-            # Отправляем запрос к API с оптимизированной сессией
-            response = self.session.post(
-                f"{self.api_url}chat/completions",
-                headers=self.headers,
-                json=data
+            # Отправляем запрос к API через общую сессию
+            _, result = await self._request_calories(
+                build_body,
+                "Извините, не удалось проанализировать изображение. Попробуйте еще раз."
             )
-            
-            if response.status_code == 200:
-                result = response.json()
-                if 'choices' in result and len(result['choices']) > 0:
-                    calories = result['choices'][0]['message']['content'].strip()
-                    return f"Примерное количество калорий: {calories}"
-                else:
-                    logger.error(f"Unexpected API response format: {result}")
-                    return "Извините, не удалось получить корректный ответ от API. Попробуйте еще раз."
-            else:
-                logger.error(f"API Error: {response.status_code} - {response.text}")
-                return "Извините, не удалось проанализировать изображение. Попробуйте еще раз."
-                
-        except requests.exceptions.Timeout:
+            return result
+        
+        except CircuitOpenError:
+            logger.warning("API circuit is open, request skipped")
+            return "Сервис анализа временно недоступен. Попробуйте через минуту."
+        except asyncio.TimeoutError:
             logger.error("API request timeout")
             return "Превышено время ожидания ответа от сервера. Попробуйте еще раз."
-        except requests.exceptions.RequestException as e:
-            logger.error(f"API request error: {e}")
+        except aiohttp.ClientError as e:
+            logger.error("API request error: %s", e)
             return "Ошибка соединения с сервером. Попробуйте еще раз."
         except Exception as e:
-            logger.error(f"Error analyzing image: {e}")
+            logger.error("Error analyzing image: %s", e)
             return "Произошла ошибка при анализе изображения. Попробуйте еще раз."
     
-    def analyze_text(self, text_description: str) -> str:
+    async def analyze_text(self, text_description: str) -> str:
         """Анализ текстового описания еды через Nebius API"""
         try:
-            # Данные для запроса
-            data = {
-                "model": "Qwen/Qwen2.5-VL-72B-Instruct",
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": f"Проанализируй это описание еды и определи примерное количество калорий: '{text_description}'. Ответь только числом калорий, без дополнительного текста."
-                    }
-                ],
-                "max_tokens": 50,
-                "temperature": 0.1
-            }
+            # Эмбеддинг считается в пуле потоков, чтобы не блокировать event loop
+            loop = asyncio.get_running_loop()
+            semantic_cache = self._semantic_cache
+            if semantic_cache is not None and not semantic_cache.ready:
+                semantic_cache = None  # модель еще загружается
+            if semantic_cache is not None:
+                cached = await loop.run_in_executor(None, semantic_cache.get, text_description)
+                if cached is not None:
+                    return cached
             
-            # Отправляем запрос к API с оптимизированной сессией
-            response = self.session.post(
-                f"{self.api_url}chat/completions",
-                headers=self.headers,
-                json=data
+            # Тело запроса: экранируется только само описание
+            encoded_prompt = orjson.dumps(text_description)
+            
+            def build_body(model: str) -> bytes:
+                prefix, suffix = _TEXT_REQUEST_TEMPLATES[model]
+                return b"".join((prefix, encoded_prompt, suffix))
+            
+            # Отправляем запрос к API через общую сессию
+            success, result = await self._request_calories(
+                build_body,
+                "Извините, не удалось проанализировать описание. Попробуйте еще раз."
             )
             
-            if response.status_code == 200:
-                result = response.json()
-                if 'choices' in result and len(result['choices']) > 0:
-                    calories = result['choices'][0]['message']['content'].strip()
-                    return f"Примерное количество калорий: {calories}"
-                else:
-                    logger.error(f"Unexpected API response format: {result}")
-                    return "Извините, не удалось получить корректный ответ от API. Попробуйте еще раз."
-            else:
-                logger.error(f"API Error: {response.status_code} - {response.text}")
-                return "Извините, не удалось проанализировать описание. Попробуйте еще раз."
-                
-        except requests.exceptions.Timeout:
+            # Кэшируем только успешные ответы
+            if success and semantic_cache is not None:
+                await loop.run_in_executor(None, semantic_cache.put, text_description, result)
+            return result
+        
+        except CircuitOpenError:
+            logger.warning("API circuit is open, request skipped")
+            return "Сервис анализа временно недоступен. Попробуйте через минуту."
+        except asyncio.TimeoutError:
             logger.error("API request timeout")
             return "Превышено время ожидания ответа от сервера. Попробуйте еще раз."
-        except requests.exceptions.RequestException as e:
-            logger.error(f"API request error: {e}")
+        except aiohttp.ClientError as e:
+            logger.error("API request error: %s", e)
             return "Ошибка соединения с сервером. Попробуйте еще раз."
         except Exception as e:
-            logger.error(f"Error analyzing text: {e}")
+            logger.error("Error analyzing text: %s", e)
             return "Произошла ошибка при анализе описания. Попробуйте еще раз."
 
 # Создаем глобальный экземпляр клиента
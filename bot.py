@@ -1,278 +1,387 @@
 import logging
 import io
-import os
-import tempfile
 import asyncio
-from datetime import datetime, time
-from typing import Optional, Dict, Any
-from collections import OrderedDict
-import speech_recognition as sr
-from pydub import AudioSegment
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+import subprocess
+from datetime import datetime, time, timedelta
+from typing import Optional, Dict, Any, Awaitable, Callable, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from cachetools import TTLCache
+# soundfile декодирует OGG/Opus и кодирует FLAC в памяти без ffmpeg (нужен libsndfile >= 1.0.29)
+try:
+    import soundfile as sf
+except ImportError:
+    sf = None
+# diskcache хранит ответы API в SQLite на диске, чтобы кэш переживал перезапуски
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, PhotoSize, Voice
+from telegram.ext import (
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes,
+    PicklePersistence, PersistenceInput, AIORateLimiter
+)
+from telegram.helpers import escape_markdown
 
 # Импортируем наши модули
 from database import UserDatabase
+from calorie_writer import CalorieRecordWriter
+from update_processor import PerChatUpdateProcessor
 
-from config import setup_logging, API_CACHE_SIZE, BOT_TOKEN
+from config import (
+    setup_logging, BOT_STATE_PATH, TELEGRAM_RATE_LIMIT_RETRIES,
+    MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES_PER_CHAT,
+    API_CACHE_SIZE, API_CACHE_TTL, API_CACHE_DIR, API_CACHE_DISK_SIZE_LIMIT, API_CACHE_DISK_TTL,
+    BOT_TOKEN, STT_WORKERS, VOICE_SAMPLE_RATE,
+    VOICE_FAILURE_CACHE_SIZE, VOICE_UNRECOGNIZED_TTL, VOICE_REQUEST_ERROR_TTL
+)
 from utils import (
     validate_user_input, extract_calories_from_text, 
-    format_calorie_response, safe_reply, create_image_hash, create_text_hash
+    format_calorie_response, safe_reply, create_image_hash, create_text_hash,
+    format_profile, format_record_time
 )
 from api_client import api_client
+from speech_client import speech_client, SpeechNotRecognizedError, SpeechServiceError
 
 # Настройка логирования
 logger = setup_logging()
 
-# Инициализация базы данных
+# База данных (таблицы создаются в on_startup: импорт модуля не обращается к базе,
+# он повторяется в каждом процессе пула изображений)
 db = UserDatabase()
+# Записи истории калорий копятся несколько миллисекунд и пишутся одной транзакцией
+calorie_writer = CalorieRecordWriter(db)
+
+# Перекодирование голосовых в FLAC нагружает CPU: выполняем его в отдельном пуле,
+# размер пула ограничивает число одновременных декодирований
+stt_executor = ThreadPoolExecutor(max_workers=STT_WORKERS, thread_name_prefix="stt")
+# Неудачные распознавания: ключ голосового -> время (loop.time()), до которого не повторяем
+voice_failures = TTLCache(maxsize=VOICE_FAILURE_CACHE_SIZE, ttl=VOICE_UNRECOGNIZED_TTL)
 
-# Оптимизированный кэш с ограничением размера (LRU)
-api_cache = OrderedDict()
+# Кэш ответов: на диске, если доступен diskcache, иначе в памяти с ограничением
+# размера (LRU) и времени жизни записей. TTLCache трогаем только из event loop,
+# а обращения к diskcache (SQLite с fsync при записи) выполняем в пуле потоков
+if diskcache is not None and API_CACHE_DIR:
+    api_cache = diskcache.Cache(API_CACHE_DIR, size_limit=API_CACHE_DISK_SIZE_LIMIT)
+else:
+    if API_CACHE_DIR:
+        logger.warning("diskcache not available, API cache will be kept in memory only")
+    api_cache = TTLCache(maxsize=API_CACHE_SIZE, ttl=API_CACHE_TTL)
 
+async def get_api_result(key: str) -> Optional[str]:
+    """Чтение ответа API из кэша"""
+    if isinstance(api_cache, TTLCache):
+        return api_cache.get(key)
+    return await asyncio.to_thread(api_cache.get, key)
 
-def _update_cache(cache: OrderedDict, key: str, value: str, max_size: int):
-    """Обновление кэша с LRU логикой"""
-    if key in cache:
-        # Перемещаем в конец (последний использованный)
-        cache.move_to_end(key)
+async def store_api_result(key: str, result: str) -> None:
+    """Сохранение ответа API в кэш (diskcache задает срок жизни при записи)"""
+    if isinstance(api_cache, TTLCache):
+        api_cache[key] = result
     else:
-        # Добавляем новый элемент
-        cache[key] = value
-        # Если превышен лимит, удаляем самый старый элемент
-        if len(cache) > max_size:
-            cache.popitem(last=False)
+        await asyncio.to_thread(api_cache.set, key, result, expire=API_CACHE_DISK_TTL)
+
+# Запросы к API, которые выполняются сейчас: одинаковые фото и описания,
+# пришедшие одновременно, ждут один ответ вместо повторных вызовов
+inflight_api_requests: Dict[str, asyncio.Future] = {}
+
+async def cached_analysis(key: str, kind: str, request: Callable[[], Awaitable[str]]) -> str:
+    """Ответ из кэша, из уже идущего запроса с тем же ключом или новый запрос к API"""
+    inflight = inflight_api_requests.get(key)
+    if inflight is not None:
+        logger.info("Joining in-flight request for %s analysis", kind)
+        return await asyncio.shield(inflight)
+    
+    # Регистрируемся до первого await, чтобы параллельный запрос с тем же ключом присоединился
+    future = asyncio.get_running_loop().create_future()
+    inflight_api_requests[key] = future
+    try:
+        result_text = await get_api_result(key)
+        if result_text is not None:
+            logger.info("Using cached result for %s analysis", kind)
+        else:
+            result_text = await request()
+            # Кэшируем только ответы с калориями, но не сообщения об ошибках
+            if extract_calories_from_text(result_text) is not None:
+                await store_api_result(key, result_text)
+        future.set_result(result_text)
+        return result_text
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # ожидающих может не быть: помечаем исключение как полученное
+        raise
+    finally:
+        if not future.done():
+            future.cancel()
+        inflight_api_requests.pop(key, None)
+
+# Неизменяемые клавиатуры создаются один раз при импорте и переиспользуются
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🍽️ Добавить блюдо", callback_data="add_food")],
+    [InlineKeyboardButton("🔍 Хочу знать сколько калорий", callback_data="quick_analysis")],
+    [InlineKeyboardButton("📋 Меню", callback_data="main_menu_submenu")]
+])
+DAYRES_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🍽️ Добавить блюдо", callback_data="add_food")],
+    [InlineKeyboardButton("🔍 Быстрый анализ", callback_data="quick_analysis")],
+    [InlineKeyboardButton("📋 Меню", callback_data="main_menu_submenu")]
+])
+REGISTRATION_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Начать регистрацию", callback_data="start_registration")]
+])
+RESTART_REGISTRATION_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Начать заново", callback_data="start_registration")]
+])
+START_ANALYSIS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🍕 Начать анализ еды", callback_data="back_to_main")]
+])
+PROFILE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✏️ Редактировать профиль", callback_data="edit_profile")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+])
+HISTORY_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 Сегодня", callback_data="history_today")],
+    [InlineKeyboardButton("📅 Вчера", callback_data="history_yesterday")],
+    [InlineKeyboardButton("📅 За неделю", callback_data="history_week")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+])
+HISTORY_RESULT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Выбрать другой период", callback_data="history")],
+    [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
+])
+SUBMENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👤 Мой профиль", callback_data="profile")],
+    [InlineKeyboardButton("📊 История калорий", callback_data="history")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
+])
+QUICK_ANALYSIS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📸 По фотографии", callback_data="quick_photo_analysis")],
+    [InlineKeyboardButton("📝 По описанию", callback_data="quick_text_analysis")],
+    [InlineKeyboardButton("🎤 По голосовому сообщению", callback_data="quick_voice_analysis")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
+])
+ADD_FOOD_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📸 По фотографии", callback_data="photo_analysis")],
+    [InlineKeyboardButton("📝 По описанию", callback_data="text_analysis")],
+    [InlineKeyboardButton("🎤 По голосовому сообщению", callback_data="voice_analysis")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="meal_type")]
+])
+GENDER_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Мужской", callback_data="gender_male")],
+    [InlineKeyboardButton("Женский", callback_data="gender_female")]
+])
+ACTIVITY_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏢 Сидячая работа (офис, учеба)", callback_data="activity_sedentary")],
+    [InlineKeyboardButton("🚶 Легкая активность (прогулки, домашние дела)", callback_data="activity_light")],
+    [InlineKeyboardButton("🏃 Умеренная активность (спорт 3-5 раз/неделю)", callback_data="activity_moderate")],
+    [InlineKeyboardButton("💪 Высокая активность (спорт 6-7 раз/неделю)", callback_data="activity_high")],
+    [InlineKeyboardButton("🏗️ Физическая работа (строительство, грузчик)", callback_data="activity_very_high")]
+])
+RESET_CONFIRM_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Да, сбросить все данные", callback_data="confirm_reset")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reset")]
+])
+
+# Приемы пищи: ключ -> название; callback_data кнопки -> ключ
+MEAL_NAMES = {
+    "breakfast": "🌅 Завтрак",
+    "lunch": "🍽️ Обед",
+    "dinner": "🌙 Ужин",
+    "snack": "🍎 Перекус"
+}
+MEAL_CALLBACKS = {f"meal_{key}": key for key in MEAL_NAMES}
+# Основные приемы пищи добавляются один раз в день, перекус - без ограничений
+MAIN_MEALS = ("breakfast", "lunch", "dinner")
+# Выбранные за день основные приемы пищи хранятся битовой маской в user_data
+MEAL_BITS = {key: 1 << index for index, key in enumerate(MAIN_MEALS)}
+
+def _build_meal_type_markup(selected_mask: int) -> InlineKeyboardMarkup:
+    """Меню выбора приема пищи без уже выбранных сегодня"""
+    keyboard = [
+        [InlineKeyboardButton(MEAL_NAMES[key], callback_data=f"meal_{key}")]
+        for key in MAIN_MEALS if not selected_mask & MEAL_BITS[key]
+    ]
+    keyboard.append([InlineKeyboardButton(MEAL_NAMES["snack"], callback_data="meal_snack")])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")])
+    return InlineKeyboardMarkup(keyboard)
+
+# Все варианты меню, индекс - маска выбранных основных приемов пищи
+MEAL_TYPE_MARKUPS = tuple(_build_meal_type_markup(mask) for mask in range(1 << len(MAIN_MEALS)))
 
-def analyze_food_image(image_data: bytes) -> str:
+# Подсказки после выбора способа добавления блюда ({meal_type} - тип приема пищи)
+ADD_FOOD_PROMPTS = {
+    "photo_analysis": "📸 Отправьте мне фотографию еды для {meal_type}, и я определю количество калорий.",
+    "text_analysis": "📝 Опишите еду текстом для {meal_type}, и я определю количество калорий.\n\nНапример: 'Большая пицца с пепперони и сыром'",
+    "voice_analysis": "🎤 Отправьте мне голосовое сообщение с описанием еды для {meal_type}, и я определю количество калорий.\n\nНапример, скажите: 'Большая пицца с пепперони и сыром'"
+}
+QUICK_ANALYSIS_PROMPTS = {
+    "quick_photo_analysis": "📸 Отправьте мне фотографию еды для быстрого анализа калорий.\n\nРезультат не будет сохранен в дневной расчет.",
+    "quick_text_analysis": "📝 Опишите еду текстом для быстрого анализа калорий.\n\nНапример: 'Большая пицца с пепперони и сыром'\n\nРезультат не будет сохранен в дневной расчет.",
+    "quick_voice_analysis": "🎤 Отправьте мне голосовое сообщение с описанием еды для быстрого анализа калорий.\n\nНапример, скажите: 'Большая пицца с пепперони и сыром'\n\nРезультат не будет сохранен в дневной расчет."
+}
+
+# Названия дней недели по номеру (0 - воскресенье, как strftime('%w') и EXTRACT(DOW))
+WEEKDAY_NAMES = ("Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday")
+
+# Пол: callback_data -> значение в профиле
+GENDERS = {
+    "gender_male": "мужской",
+    "gender_female": "женский"
+}
+# Уровни активности: callback_data -> значение в профиле
+ACTIVITY_LEVELS = {
+    "activity_sedentary": "сидячая работа",
+    "activity_light": "легкая активность",
+    "activity_moderate": "умеренная активность",
+    "activity_high": "высокая активность",
+    "activity_very_high": "физическая работа"
+}
+
+async def analyze_food_image(image_data: bytes) -> str:
     """Анализ изображения еды через Nebius API с кэшированием"""
     try:
         # Создаем хэш изображения для кэширования
         image_hash = create_image_hash(image_data)
         
-        # Проверяем кэш
-        if image_hash in api_cache:
-            logger.info("Using cached result for image analysis")
-            # Перемещаем в конец для LRU
-            api_cache.move_to_end(image_hash)
-            return api_cache[image_hash]
-        
-        # Анализируем изображение через API клиент
-        result_text = api_client.analyze_image(image_data)
-        
-        # Сохраняем в кэш с LRU логикой
-        _update_cache(api_cache, image_hash, result_text, API_CACHE_SIZE)
-        
-        return result_text
+        # Анализируем изображение через API клиент, если ответа нет в кэше
+        return await cached_analysis(
+            image_hash, "image", lambda: api_client.analyze_image(image_data)
+        )
         
     except Exception as e:
-        logger.error(f"Error analyzing image: {e}")
+        logger.error("Error analyzing image: %s", e)
         return "Произошла ошибка при анализе изображения. Попробуйте еще раз."
 
+MAIN_MENU_TEMPLATE = "🍕 Привет, {name}!\n\nВаша суточная норма калорий: {daily_calories} ккал\n\n{prompt}"
+
+async def send_main_menu(send: Callable[..., Awaitable], user: dict, prompt: str) -> None:
+    """Главное меню зарегистрированного пользователя (send - reply_text или edit_message_text)"""
+    text = MAIN_MENU_TEMPLATE.format(
+        name=user.get('name', 'пользователь'), daily_calories=user.get('daily_calories', 0), prompt=prompt
+    )
+    await send(text, reply_markup=MAIN_MENU_MARKUP)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
     user_id = update.effective_user.id
     username = update.effective_user.username or "unknown"
     
-    logger.info(f"User {user_id} ({username}) started the bot")
+    logger.info("User %s (%s) started the bot", user_id, username)
     
     # Проверяем, нужно ли сбросить счетчик (новый день)
-    await check_and_reset_daily_meals(context)
+    check_and_reset_daily_meals(context)
     
     # Проверяем, зарегистрирован ли пользователь
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
     
     if not user:
         # Пользователь не зарегистрирован, начинаем регистрацию
-        logger.info(f"New user {user_id} ({username}) starting registration")
+        logger.info("New user %s (%s) starting registration", user_id, username)
         await start_registration(update, context)
     else:
         # Пользователь зарегистрирован, показываем главное меню
-        logger.info(f"Existing user {user_id} ({username}) accessing main menu")
-        keyboard = [
-            [InlineKeyboardButton("🍽️ Добавить блюдо", callback_data="add_food")],
-            [InlineKeyboardButton("🔍 Хочу знать сколько калорий", callback_data="quick_analysis")],
-            [InlineKeyboardButton("📋 Меню", callback_data="main_menu_submenu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        daily_calories = user.get('daily_calories', 0)
-        await update.message.reply_text(
-            f"🍕 Привет, {user.get('name', 'пользователь')}!\n\n"
-            f"Ваша суточная норма калорий: {daily_calories} ккал\n\n"
-            f"Выберите действие:",
-            reply_markup=reply_markup
-        )
+        logger.info("Existing user %s (%s) accessing main menu", user_id, username)
+        await send_main_menu(update.message.reply_text, user, "Выберите действие:")
 
 async def start_registration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Начало процесса регистрации"""
-    keyboard = [
-        [InlineKeyboardButton("📝 Начать регистрацию", callback_data="start_registration")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
         "🍕 Добро пожаловать! Для точного расчета калорий мне нужна информация о вас.\n\n"
         "Я задам несколько вопросов о вашем возрасте, росте, весе и физической активности.\n\n"
         "Нажмите кнопку ниже, чтобы начать регистрацию:",
-        reply_markup=reply_markup
+        reply_markup=REGISTRATION_MARKUP
     )
 
 
-def analyze_food_text(text_description: str) -> str:
+async def analyze_food_text(text_description: str) -> str:
     """Анализ текстового описания еды через Nebius API с кэшированием"""
     try:
         # Создаем хэш текста для кэширования
         text_hash = create_text_hash(text_description)
         
-        # Проверяем кэш
-        if text_hash in api_cache:
-            logger.info("Using cached result for text analysis")
-            # Перемещаем в конец для LRU
-            api_cache.move_to_end(text_hash)
-            return api_cache[text_hash]
-        
-        # Анализируем текст через API клиент
-        result_text = api_client.analyze_text(text_description)
-        
-        # Сохраняем в кэш с LRU логикой
-        _update_cache(api_cache, text_hash, result_text, API_CACHE_SIZE)
-        
-        return result_text
+        # Анализируем текст через API клиент, если ответа нет в кэше
+        return await cached_analysis(
+            text_hash, "text", lambda: api_client.analyze_text(text_description)
+        )
         
     except Exception as e:
-        logger.error(f"Error analyzing text: {e}")
+        logger.error("Error analyzing text: %s", e)
         return "Произошла ошибка при анализе описания. Попробуйте еще раз."
 
-def transcribe_voice(audio_data: bytes) -> Optional[str]:
-    """Транскрипция голосового сообщения в текст с использованием временных файлов"""
-    temp_files = []
+def _encode_voice_flac(audio_file: io.BytesIO) -> Tuple[bytes, int]:
+    """Перекодирование OGG/Opus голосового сообщения в моно FLAC в памяти (байты и частота)"""
+    if sf is not None:
+        try:
+            samples, sample_rate = sf.read(audio_file, dtype='int16')
+            # Стерео сводим в моно
+            if samples.ndim > 1:
+                samples = samples.mean(axis=1).astype('int16')
+            flac_file = io.BytesIO()
+            sf.write(flac_file, samples, sample_rate, format='FLAC', subtype='PCM_16')
+            return flac_file.getvalue(), sample_rate
+        except RuntimeError as e:
+            # Старый libsndfile не умеет Opus
+            logger.warning("soundfile could not decode voice, falling back to ffmpeg: %s", e)
     
-    try:
-        # Создаем временные файлы с уникальными именами
-        with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as temp_ogg:
-            temp_ogg.write(audio_data)
-            temp_ogg_path = temp_ogg.name
-            temp_files.append(temp_ogg_path)
-        
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_wav:
-            temp_wav_path = temp_wav.name
-            temp_files.append(temp_wav_path)
-        
-        # Конвертируем OGG в WAV
-        audio = AudioSegment.from_ogg(temp_ogg_path)
-        audio.export(temp_wav_path, format="wav")
-        
-        # Инициализируем распознаватель речи
-        recognizer = sr.Recognizer()
-        
-        # Распознаем речь
-        with sr.AudioFile(temp_wav_path) as source:
-            audio_record = recognizer.record(source)
-            text = recognizer.recognize_google(audio_record, language="ru-RU")
-        
-        logger.info(f"Successfully transcribed voice: {text[:50]}...")
-        return text
-        
-    except sr.UnknownValueError:
-        logger.warning("Could not understand audio")
-        return None
-    except sr.RequestError as e:
-        logger.error(f"Error with speech recognition service: {e}")
-        return None
-    except Exception as e:
-        logger.error(f"Error transcribing voice: {e}")
-        return None
-    finally:
-        # Удаляем временные файлы в любом случае
-        for temp_file in temp_files:
-            try:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
-            except OSError as e:
-                logger.warning(f"Could not remove temp file {temp_file}: {e}")
+    # ffmpeg читает OGG из stdin и пишет моно FLAC в stdout: без временных файлов
+    process = subprocess.run(
+        ["ffmpeg", "-loglevel", "quiet", "-i", "pipe:0",
+         "-ar", str(VOICE_SAMPLE_RATE), "-ac", "1", "-f", "flac", "pipe:1"],
+        input=audio_file.getvalue(), capture_output=True, check=True
+    )
+    return process.stdout, VOICE_SAMPLE_RATE
+
+async def transcribe_voice(audio_file: io.BytesIO) -> str:
+    """Транскрипция голосового сообщения в текст без временных файлов
+    
+    Перекодирование выполняется в пуле stt_executor, запрос к Google - асинхронно в event loop.
+    Ошибки распознавания (SpeechNotRecognizedError, SpeechServiceError) пробрасываются вызывающему.
+    """
+    loop = asyncio.get_running_loop()
+    flac_data, sample_rate = await loop.run_in_executor(stt_executor, _encode_voice_flac, audio_file)
+    text = await speech_client.recognize(flac_data, sample_rate)
+    
+    logger.info("Successfully transcribed voice: %.50s...", text)
+    return text
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик нажатий на кнопки"""
     query = update.callback_query
     await query.answer()
     
-    if query.data == "start_registration":
-        await start_registration_flow(query, context)
-    elif query.data == "photo_analysis":
-        meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
-        await query.edit_message_text(f"📸 Отправьте мне фотографию еды для {meal_type}, и я определю количество калорий.")
-    elif query.data == "text_analysis":
-        meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
-        await query.edit_message_text(f"📝 Опишите еду текстом для {meal_type}, и я определю количество калорий.\n\nНапример: 'Большая пицца с пепперони и сыром'")
-    elif query.data == "voice_analysis":
-        meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
-        await query.edit_message_text(f"🎤 Отправьте мне голосовое сообщение с описанием еды для {meal_type}, и я определю количество калорий.\n\nНапример, скажите: 'Большая пицца с пепперони и сыром'")
-    elif query.data == "quick_photo_analysis":
-        context.user_data['quick_analysis_mode'] = True
-        await query.edit_message_text("📸 Отправьте мне фотографию еды для быстрого анализа калорий.\n\nРезультат не будет сохранен в дневной расчет.")
-    elif query.data == "quick_text_analysis":
-        context.user_data['quick_analysis_mode'] = True
-        await query.edit_message_text("📝 Опишите еду текстом для быстрого анализа калорий.\n\nНапример: 'Большая пицца с пепперони и сыром'\n\nРезультат не будет сохранен в дневной расчет.")
-    elif query.data == "quick_voice_analysis":
-        context.user_data['quick_analysis_mode'] = True
-        await query.edit_message_text("🎤 Отправьте мне голосовое сообщение с описанием еды для быстрого анализа калорий.\n\nНапример, скажите: 'Большая пицца с пепперони и сыром'\n\nРезультат не будет сохранен в дневной расчет.")
-    elif query.data == "profile":
-        await show_profile(query, context)
-    elif query.data == "history":
-        await show_calorie_history_menu(query, context)
-    elif query.data == "history_today":
-        await show_calorie_history(query, context, "today")
-    elif query.data == "history_yesterday":
-        await show_calorie_history(query, context, "yesterday")
-    elif query.data == "history_week":
-        await show_calorie_history(query, context, "week")
-    elif query.data == "back_to_main":
-        await show_main_menu(query, context)
-    elif query.data == "add_food":
-        await show_meal_type_menu(query, context)
-    elif query.data == "quick_analysis":
-        await show_quick_analysis_menu(query, context)
-    elif query.data == "main_menu_submenu":
-        await show_main_menu_submenu(query, context)
-    elif query.data in ["meal_breakfast", "meal_lunch", "meal_dinner", "meal_snack"]:
-        # Проверяем, нужно ли сбросить счетчик (новый день)
-        await check_and_reset_daily_meals(context)
-        
-        # Сохраняем выбранный тип приема пищи в контекст
-        meal_types = {
-            "meal_breakfast": "🌅 Завтрак",
-            "meal_lunch": "🍽️ Обед", 
-            "meal_dinner": "🌙 Ужин",
-            "meal_snack": "🍎 Перекус"
-        }
-        meal_keys = {
-            "meal_breakfast": "breakfast",
-            "meal_lunch": "lunch",
-            "meal_dinner": "dinner",
-            "meal_snack": "snack"
-        }
-        
-        context.user_data['selected_meal_type'] = meal_types[query.data]
-        
-        # Добавляем выбранный тип приема пищи в список (кроме перекуса)
-        if query.data != "meal_snack":
-            if 'selected_meals_today' not in context.user_data:
-                context.user_data['selected_meals_today'] = set()
-            context.user_data['selected_meals_today'].add(meal_keys[query.data])
-        
-        await show_add_food_menu(query, context)
-    elif query.data == "meal_type":
-        await show_meal_type_menu(query, context)
-    elif query.data.startswith("gender_"):
-        await handle_gender_selection(query, context)
-    elif query.data.startswith("activity_"):
-        await handle_activity_selection(query, context)
-    elif query.data == "edit_profile":
-        await start_registration_flow(query, context)
-    elif query.data == "confirm_reset":
-        await confirm_reset(query, context)
-    elif query.data == "cancel_reset":
-        await cancel_reset(query, context)
+    # Точное совпадение callback_data, затем префикс (gender_*, activity_*)
+    handler = CALLBACK_HANDLERS.get(query.data)
+    if handler is None:
+        handler = CALLBACK_PREFIX_HANDLERS.get(query.data.split("_", 1)[0])
+    if handler is not None:
+        await handler(query, context)
+
+async def show_add_food_prompt(query, context):
+    """Подсказка для выбранного способа добавления блюда"""
+    meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
+    await query.edit_message_text(ADD_FOOD_PROMPTS[query.data].format(meal_type=meal_type))
+
+async def show_quick_analysis_prompt(query, context):
+    """Подсказка для выбранного способа быстрого анализа"""
+    context.user_data['quick_analysis_mode'] = True
+    await query.edit_message_text(QUICK_ANALYSIS_PROMPTS[query.data])
+
+async def handle_meal_selection(query, context):
+    """Обработка выбора типа приема пищи"""
+    user_state = context.user_data
+    # Проверяем, нужно ли сбросить счетчик (новый день)
+    check_and_reset_daily_meals(context)
+    
+    # Сохраняем выбранный тип приема пищи в контекст
+    meal_key = MEAL_CALLBACKS[query.data]
+    user_state['selected_meal_type'] = MEAL_NAMES[meal_key]
+    
+    # Добавляем выбранный тип приема пищи в список (кроме перекуса)
+    if meal_key != "snack":
+        user_state['selected_meals_mask'] = user_state.get('selected_meals_mask', 0) | MEAL_BITS[meal_key]
+    
+    await show_add_food_menu(query, context)
 
 async def start_registration_flow(query, context):
     """Начало процесса регистрации"""
@@ -296,69 +405,35 @@ async def start_registration_flow(query, context):
 async def show_profile(query, context):
     """Показ профиля пользователя"""
     user_id = query.from_user.id
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
     
     if user:
-        profile_text = f"👤 Ваш профиль:\n\n"
-        profile_text += f"Имя: {user.get('name', 'Не указано')}\n"
-        profile_text += f"Пол: {user.get('gender', 'Не указан')}\n"
-        profile_text += f"Возраст: {user.get('age', 'Не указан')} лет\n"
-        profile_text += f"Рост: {user.get('height', 'Не указан')} см\n"
-        profile_text += f"Вес: {user.get('weight', 'Не указан')} кг\n"
-        # Форматируем уровень активности для лучшего отображения
-        activity_display = {
-            'сидячая работа': '🏢 Сидячая работа (офис, учеба)',
-            'легкая активность': '🚶 Легкая активность (прогулки, домашние дела)',
-            'умеренная активность': '🏃 Умеренная активность (спорт 3-5 раз/неделю)',
-            'высокая активность': '💪 Высокая активность (спорт 6-7 раз/неделю)',
-            'физическая работа': '🏗️ Физическая работа (строительство, грузчик)'
-        }
-        activity_level = user.get('activity_level', 'Не указан')
-        activity_text = activity_display.get(activity_level, activity_level)
-        profile_text += f"Уровень активности: {activity_text}\n"
-        daily_calories = user.get('daily_calories', 'Не рассчитана')
-        if daily_calories != 'Не рассчитана':
-            profile_text += f"Суточная норма калорий: **{daily_calories} ккал**\n\n"
-            profile_text += "📊 **Расчет основан на:**\n"
-            profile_text += f"• Формула Миффлина-Сан Жеора\n"
-            profile_text += f"• Ваш уровень активности\n"
-        else:
-            profile_text += f"Суточная норма калорий: {daily_calories}"
-        
-        keyboard = [
-            [InlineKeyboardButton("✏️ Редактировать профиль", callback_data="edit_profile")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        profile_text = format_profile(
+            user.get('name', 'Не указано'), user.get('gender', 'Не указан'),
+            user.get('age', 'Не указан'), user.get('height', 'Не указан'),
+            user.get('weight', 'Не указан'), user.get('activity_level', 'Не указан'),
+            user.get('daily_calories', 'Не рассчитана')
+        )
         
-        await query.edit_message_text(profile_text, reply_markup=reply_markup, parse_mode='Markdown')
+        await query.edit_message_text(profile_text, reply_markup=PROFILE_MARKUP, parse_mode='Markdown')
     else:
         await query.edit_message_text("❌ Профиль не найден. Начните регистрацию заново.")
 
 async def show_calorie_history_menu(query, context):
     """Показ меню истории калорий"""
-    keyboard = [
-        [InlineKeyboardButton("📅 Сегодня", callback_data="history_today")],
-        [InlineKeyboardButton("📅 Вчера", callback_data="history_yesterday")],
-        [InlineKeyboardButton("📅 За неделю", callback_data="history_week")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await query.edit_message_text(
         "📊 **История калорий**\n\n"
         "Выберите период для просмотра:",
-        reply_markup=reply_markup,
+        reply_markup=HISTORY_MENU_MARKUP,
         parse_mode='Markdown'
     )
 
 async def show_calorie_history(query, context, period="today"):
     """Показ истории калорий за выбранный период"""
     user_id = query.from_user.id
-    from datetime import datetime, date, timedelta
     
-    # Определяем даты в зависимости от периода
-    today = date.today()
+    # Определяем даты в зависимости от периода (день - по UTC, как created_at в базе)
+    today = db.today()
     if period == "today":
         start_date = today
         end_date = today
@@ -376,11 +451,17 @@ async def show_calorie_history(query, context, period="today"):
         end_date = today
         period_name = "сегодня"
     
-    # Получаем историю за период
-    history = db.get_user_calorie_history_by_period(user_id, start_date, end_date)
-    logger.info(f"Retrieved {len(history)} records for user {user_id} from {start_date} to {end_date}")
-    
-    if history:
+    if period == "week":
+        # Для недели суммы по дням считает база данных
+        daily_totals = await asyncio.to_thread(db.get_daily_calorie_totals, user_id, start_date, end_date)
+        logger.info("Retrieved %s daily totals for user %s from %s to %s", len(daily_totals), user_id, start_date, end_date)
+        has_records = bool(daily_totals)
+        total_calories = sum(day['calories'] for day in daily_totals)
+    else:
+        # Получаем историю за период
+        history = await asyncio.to_thread(db.get_user_calorie_history_by_period, user_id, start_date, end_date)
+        logger.info("Retrieved %s records for user %s from %s to %s", len(history), user_id, start_date, end_date)
+        has_records = bool(history)
         total_calories = 0
         for record in history:
             calories = record['calories']
@@ -388,139 +469,80 @@ async def show_calorie_history(query, context, period="today"):
                 try:
                     calories = int(calories)
                 except ValueError:
-                    logger.warning(f"Invalid calories value: {calories}")
+                    logger.warning("Invalid calories value: %s", calories)
                     continue
             total_calories += calories
-        history_text = f"📊 **История калорий за {period_name}**\n\n"
-        history_text += f"**Общее количество калорий: {total_calories} ккал**\n\n"
+    
+    if has_records:
+        lines = [
+            f"📊 **История калорий за {period_name}**",
+            "",
+            f"**Общее количество калорий: {total_calories} ккал**",
+            ""
+        ]
         
         if period == "week":
-            # Для недели используем новую функцию
-            weekly_data = db.get_weekly_calories_summary(user_id)
-            daily_data = weekly_data['daily_data']
-            total_weekly = weekly_data['total_weekly']
-            
-            history_text += f"**Недельная сводка:**\n"
-            history_text += f"Всего за неделю: {total_weekly} ккал\n\n"
+            lines += ["**Недельная сводка:**", f"Всего за неделю: {total_calories} ккал", ""]
             
-            # Показываем данные по дням
-            for date_str, data in daily_data.items():
-                try:
-                    date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-                    day_name = date_obj.strftime('%A')
-                    calories = data['calories']
-                    meals = data['meals']
-                    history_text += f"📅 **{day_name}** ({date_str}): {calories} ккал ({meals} приемов)\n"
-                except Exception as e:
-                    logger.warning(f"Error formatting date {date_str}: {e}")
-                    history_text += f"📅 **{date_str}**: {data['calories']} ккал ({data['meals']} приемов)\n"
+            # Показываем данные по дням (день недели тоже вычислен в базе данных)
+            lines.extend(
+                f"📅 **{WEEKDAY_NAMES[day['weekday']]}** ({day['date']}): {day['calories']} ккал ({day['meals']} приемов)"
+                for day in daily_totals
+            )
+            lines.append("")
         else:
             # Для сегодня и вчера показываем детальный список
             for record in history:
-                # Форматируем дату и время
-                try:
-                    # Пробуем разные форматы даты
-                    created_at = record['created_at']
-                    
-                    if isinstance(created_at, str):
-                        if 'T' in created_at:
-                            # ISO формат
-                            record_datetime = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                        else:
-                            # SQLite формат
-                            record_datetime = datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
-                    else:
-                        # Если это уже объект datetime
-                        record_datetime = created_at
-                    
-                    formatted_time = record_datetime.strftime("%H:%M")
-                except Exception as e:
-                    # Если не удается распарсить дату, показываем как есть
-                    logger.warning(f"Error parsing time for record: {e}")
-                    if isinstance(record['created_at'], str) and ' ' in record['created_at']:
-                        formatted_time = record['created_at'].split(' ')[-1][:5]
-                    else:
-                        formatted_time = "неизвестно"
-                
-                history_text += f"• {record['food_name']}: {record['calories']} ккал\n"
-                history_text += f"  Источник: {record['source']} | {formatted_time}\n\n"
-        
-        keyboard = [
-            [InlineKeyboardButton("📊 Выбрать другой период", callback_data="history")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(history_text, reply_markup=reply_markup, parse_mode='Markdown')
+                formatted_time = format_record_time(record['created_at'])
+                lines += [
+                    f"• {record['food_name']}: {record['calories']} ккал",
+                    f"  Источник: {record['source']} | {formatted_time}",
+                    ""
+                ]
+        
+        history_text = "\n".join(lines)
+        await query.edit_message_text(history_text, reply_markup=HISTORY_RESULT_MARKUP, parse_mode='Markdown')
     else:
-        keyboard = [
-            [InlineKeyboardButton("📊 Выбрать другой период", callback_data="history")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
             f"📊 **История калорий за {period_name}**\n\n"
             f"За этот период записей не найдено.\n\n"
             f"Начните анализировать еду, чтобы увидеть историю!",
-            reply_markup=reply_markup,
+            reply_markup=HISTORY_RESULT_MARKUP,
             parse_mode='Markdown'
         )
 
 async def show_main_menu(query, context):
     """Показ главного меню для зарегистрированных пользователей"""
     user_id = query.from_user.id
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
     
     # Проверяем, нужно ли сбросить счетчик (новый день)
-    await check_and_reset_daily_meals(context)
+    check_and_reset_daily_meals(context)
     
     if user:
-        keyboard = [
-            [InlineKeyboardButton("🍽️ Добавить блюдо", callback_data="add_food")],
-            [InlineKeyboardButton("🔍 Хочу знать сколько калорий", callback_data="quick_analysis")],
-            [InlineKeyboardButton("📋 Меню", callback_data="main_menu_submenu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        daily_calories = user.get('daily_calories', 0)
-        await query.edit_message_text(
-            f"🍕 Привет, {user.get('name', 'пользователь')}!\n\n"
-            f"Ваша суточная норма калорий: {daily_calories} ккал\n\n"
-            f"Выберите способ анализа:",
-            reply_markup=reply_markup
-        )
+        await send_main_menu(query.edit_message_text, user, "Выберите способ анализа:")
     else:
         await start_registration(query, context)
 
-async def show_analysis_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Показ меню для нового анализа после ответа"""
-    keyboard = [
-        [InlineKeyboardButton("🍽️ Добавить блюдо", callback_data="add_food")],
-        [InlineKeyboardButton("🔍 Хочу знать сколько калорий", callback_data="quick_analysis")],
-        [InlineKeyboardButton("📋 Меню", callback_data="main_menu_submenu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        "🔄 Хотите проанализировать что-то еще?",
-        reply_markup=reply_markup
-    )
+ANALYSIS_MENU_PROMPT = "🔄 Хотите проанализировать что-то еще?"
 
-async def check_and_reset_daily_meals(context):
-    """Проверяет и сбрасывает счетчик выбранных приемов пищи и общую сумму калорий в полночь"""
-    from datetime import datetime, date
-    
-    current_date = date.today()
-    last_reset_date = context.user_data.get('last_reset_date')
+async def reply_with_analysis_menu(message, text: str, **kwargs) -> None:
+    """Результат и меню для нового анализа одним сообщением (один запрос к Telegram вместо двух)"""
+    await message.reply_text(f"{text}\n\n{ANALYSIS_MENU_PROMPT}", reply_markup=MAIN_MENU_MARKUP, **kwargs)
+
+def check_and_reset_daily_meals(context) -> None:
+    """Проверяет и сбрасывает счетчик выбранных приемов пищи в полночь"""
+    user_state = context.user_data
+    # Обычная функция: ввода-вывода нет, корутина здесь не нужна.
+    # День считается по UTC, как и суммы калорий в базе
+    current_date = db.today()
+    last_reset_date = user_state.get('last_reset_date')
     
     # Если это новый день, сбрасываем счетчик
     if last_reset_date != current_date:
-        context.user_data['selected_meals_today'] = set()
-        context.user_data['last_reset_date'] = current_date
-        # Сбрасываем общую сумму калорий за день
-        context.user_data['daily_calories_sum'] = 0
-        logger.info(f"Daily meals reset for new day: {current_date}")
+        user_state['selected_meals_mask'] = 0
+        user_state['last_reset_date'] = current_date
+        logger.info("Daily meals reset for new day: %s", current_date)
 
 # Удаляем сложные функции планировщика - используем простую логику проверки при каждом взаимодействии
 
@@ -531,37 +553,19 @@ async def show_meal_type_menu(query, context):
     user_id = query.from_user.id
     
     # Проверяем, нужно ли сбросить счетчик (новый день)
-    await check_and_reset_daily_meals(context)
+    check_and_reset_daily_meals(context)
     
     # Получаем уже выбранные типы приема пищи за сегодня
-    selected_meals = context.user_data.get('selected_meals_today', set())
-    
-    # Создаем кнопки только для не выбранных типов приема пищи
-    keyboard = []
-    
-    if "breakfast" not in selected_meals:
-        keyboard.append([InlineKeyboardButton("🌅 Завтрак", callback_data="meal_breakfast")])
-    if "lunch" not in selected_meals:
-        keyboard.append([InlineKeyboardButton("🍽️ Обед", callback_data="meal_lunch")])
-    if "dinner" not in selected_meals:
-        keyboard.append([InlineKeyboardButton("🌙 Ужин", callback_data="meal_dinner")])
-    
-    # Перекус всегда доступен
-    keyboard.append([InlineKeyboardButton("🍎 Перекус", callback_data="meal_snack")])
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")])
+    selected_mask = context.user_data.get('selected_meals_mask', 0)
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Готовая клавиатура только с не выбранными типами приема пищи
+    selected_main_meals = [key for key in MAIN_MEALS if selected_mask & MEAL_BITS[key]]
+    reply_markup = MEAL_TYPE_MARKUPS[selected_mask]
     
     # Формируем сообщение с информацией о выбранных приемах пищи
     selected_text = ""
-    if selected_meals:
-        meal_names = []
-        if "breakfast" in selected_meals:
-            meal_names.append("🌅 Завтрак")
-        if "lunch" in selected_meals:
-            meal_names.append("🍽️ Обед")
-        if "dinner" in selected_meals:
-            meal_names.append("🌙 Ужин")
+    if selected_main_meals:
+        meal_names = [MEAL_NAMES[key] for key in selected_main_meals]
         selected_text = f"\n\n✅ Уже добавлено сегодня: {', '.join(meal_names)}"
     
     await query.edit_message_text(
@@ -573,227 +577,206 @@ async def show_meal_type_menu(query, context):
 
 async def show_main_menu_submenu(query, context):
     """Показ подменю главного меню"""
-    keyboard = [
-        [InlineKeyboardButton("👤 Мой профиль", callback_data="profile")],
-        [InlineKeyboardButton("📊 История калорий", callback_data="history")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await query.edit_message_text(
         "📋 **Меню**\n\n"
         "Выберите действие:",
-        reply_markup=reply_markup,
+        reply_markup=SUBMENU_MARKUP,
         parse_mode='Markdown'
     )
 
 async def show_quick_analysis_menu(query, context):
     """Показ меню быстрого анализа калорий (без сохранения в дневной расчет)"""
-    keyboard = [
-        [InlineKeyboardButton("📸 По фотографии", callback_data="quick_photo_analysis")],
-        [InlineKeyboardButton("📝 По описанию", callback_data="quick_text_analysis")],
-        [InlineKeyboardButton("🎤 По голосовому сообщению", callback_data="quick_voice_analysis")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="back_to_main")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await query.edit_message_text(
         "🔍 **Быстрый анализ калорий**\n\n"
         "Выберите способ анализа. Результат не будет сохранен в дневной расчет:",
-        reply_markup=reply_markup,
+        reply_markup=QUICK_ANALYSIS_MARKUP,
         parse_mode='Markdown'
     )
 
 async def show_add_food_menu(query, context):
     """Показ подменю для добавления блюда"""
-    keyboard = [
-        [InlineKeyboardButton("📸 По фотографии", callback_data="photo_analysis")],
-        [InlineKeyboardButton("📝 По описанию", callback_data="text_analysis")],
-        [InlineKeyboardButton("🎤 По голосовому сообщению", callback_data="voice_analysis")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="meal_type")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await query.edit_message_text(
         "🍽️ Выберите способ добавления блюда:",
-        reply_markup=reply_markup
+        reply_markup=ADD_FOOD_MARKUP
     )
 
 async def handle_gender_selection(query, context):
     """Обработка выбора пола"""
-    gender = "мужской" if query.data == "gender_male" else "женский"
-    context.user_data['registration_data']['gender'] = gender
-    context.user_data['registration_step'] = 'age'
+    user_state = context.user_data
+    gender = GENDERS.get(query.data, "женский")
+    user_state['registration_data']['gender'] = gender
+    user_state['registration_step'] = 'age'
     
     await query.edit_message_text("Введите ваш возраст:")
 
 async def handle_activity_selection(query, context):
     """Обработка выбора уровня активности"""
-    activity_map = {
-        "activity_sedentary": "сидячая работа",
-        "activity_light": "легкая активность", 
-        "activity_moderate": "умеренная активность",
-        "activity_high": "высокая активность",
-        "activity_very_high": "физическая работа"
-    }
-    
-    # Добавляем детальное логирование для отладки
-    logger.info(f"Activity selection - query.data: {repr(query.data)}")
-    logger.info(f"Activity selection - activity_map: {activity_map}")
+    user_state = context.user_data
+    activity_level = ACTIVITY_LEVELS.get(query.data, "умеренная активность")
+    # Отладочный лог: аргументы форматируются только при уровне DEBUG
+    logger.debug("Activity selection - query.data: %r, activity_level: %r", query.data, activity_level)
     
-    activity_level = activity_map.get(query.data, "умеренная активность")
-    
-    logger.info(f"Activity selection - selected activity_level: {repr(activity_level)}")
-    logger.info(f"Activity selection - activity_level type: {type(activity_level)}")
-    logger.info(f"Activity selection - activity_level.lower(): {repr(activity_level.lower())}")
-    
-    context.user_data['registration_data']['activity_level'] = activity_level
-    context.user_data['registration_step'] = 'complete'
+    user_state['registration_data']['activity_level'] = activity_level
+    user_state['registration_step'] = 'complete'
     
     # Завершаем регистрацию
-    user_data = context.user_data['registration_data']
-    logger.info(f"Activity selection - final user_data: {user_data}")
+    user_data = user_state['registration_data']
     await complete_registration(query, context, user_data)
 
-async def handle_quick_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик фотографий для быстрого анализа (без сохранения в дневной расчет)"""
+async def download_file(context: ContextTypes.DEFAULT_TYPE, file_id: str) -> bytearray:
+    """Скачивание файла (фотографии) из Telegram"""
+    file = await context.bot.get_file(file_id)
+    return await file.download_as_bytearray()
+
+async def download_and_analyze_photo(context: ContextTypes.DEFAULT_TYPE, photo: PhotoSize) -> str:
+    """Скачивание фотографии (в наилучшем качестве) и анализ одной цепочкой"""
+    async def download_and_analyze() -> str:
+        image_data = await download_file(context, photo.file_id)
+        return await analyze_food_image(image_data)
+    
+    # Повторно отправленное или пересланное фото имеет тот же file_unique_id:
+    # результат берем из кэша, не скачивая файл заново
+    return await cached_analysis(f"photo:{photo.file_unique_id}", "photo", download_and_analyze)
+
+async def download_and_transcribe(context: ContextTypes.DEFAULT_TYPE, voice: Voice) -> Optional[str]:
+    """Скачивание голосового сообщения и распознавание речи одной цепочкой"""
+    # Пересланное или повторно доставленное голосовое имеет тот же file_unique_id:
+    # распознанный текст берем из кэша, не скачивая и не декодируя файл
+    cache_key = f"voice:{voice.file_unique_id}"
+    cached = await get_api_result(cache_key)
+    if cached is not None:
+        logger.info("Using cached voice transcription")
+        return cached
+    
+    # Недавно не распознанное голосовое не отправляем в Google повторно
+    loop = asyncio.get_running_loop()
+    failed_until = voice_failures.get(cache_key)
+    if failed_until is not None and failed_until > loop.time():
+        logger.info("Skipping recently failed voice transcription")
+        return None
+    
+    # Скачиваем прямо в BytesIO: декодеры читают из него без промежуточных копий bytes
+    file = await context.bot.get_file(voice.file_id)
+    audio_file = io.BytesIO()
+    await file.download_to_memory(audio_file)
+    audio_file.seek(0)
+    
     try:
-        user_id = update.effective_user.id
-        
-        # Проверяем, зарегистрирован ли пользователь
-        user = db.get_user(user_id)
-        if not user:
-            await update.message.reply_text("❌ Сначала пройдите регистрацию командой /start")
-            return
-        
-        # Получаем информацию о фотографии
-        photo = update.message.photo[-1]  # Берем фото в наилучшем качестве
-        
-        # Скачиваем изображение
-        file = await context.bot.get_file(photo.file_id)
-        image_data = await file.download_as_bytearray()
-        
-        # Отправляем сообщение о начале анализа
-        await update.message.reply_text("🔍 Анализирую изображение для быстрого анализа...")
-        
-        # Анализируем изображение
-        result = analyze_food_image(image_data)
-        
-        # Отправляем результат без сохранения в историю
-        await update.message.reply_text(f"🔍 **Быстрый анализ калорий**\n\n{result}\n\n💡 Результат не сохранен в дневной расчет", parse_mode='Markdown')
-        
-        # Показываем меню для следующего действия
-        await show_analysis_menu(update, context)
-        
+        text = await transcribe_voice(audio_file)
+    except SpeechNotRecognizedError:
+        logger.warning("Could not understand audio")
+        voice_failures[cache_key] = loop.time() + VOICE_UNRECOGNIZED_TTL
+        return None
+    except SpeechServiceError as e:
+        # Сбой сервиса обычно временный: короткая пауза вместо повторов подряд
+        logger.error("Error with speech recognition service: %s", e)
+        voice_failures[cache_key] = loop.time() + VOICE_REQUEST_ERROR_TTL
+        return None
     except Exception as e:
-        logger.error(f"Error in quick photo analysis: {e}")
-        await update.message.reply_text("❌ Извините, не удалось проанализировать изображение. Попробуйте еще раз.")
+        logger.error("Error transcribing voice: %s", e)
+        return None
+    
+    await store_api_result(cache_key, text)
+    return text
+
+# Сообщения о начале анализа: (источник, быстрый анализ) -> текст ({meal_type} - тип приема пищи)
+ANALYSIS_STATUS_MESSAGES = {
+    ("photo", False): "Анализирую изображение для {meal_type}...",
+    ("photo", True): "🔍 Анализирую изображение для быстрого анализа...",
+    ("text", False): "Анализирую описание для {meal_type}...",
+    ("text", True): "🔍 Анализирую описание для быстрого анализа...",
+    ("voice", False): "Обрабатываю голосовое сообщение...",
+    ("voice", True): "🔍 Обрабатываю голосовое сообщение для быстрого анализа...",
+}
+QUICK_ANALYSIS_RESULT = "🔍 **Быстрый анализ калорий**\n\n{result}\n\n💡 Результат не сохранен в дневной расчет"
+# Ответ при ошибке обработки с сохранением: источник -> текст
+PROCESSING_ERROR_MESSAGES = {
+    "photo": "Произошла ошибка при обработке фотографии. Попробуйте еще раз.",
+    "text": "Произошла ошибка при обработке текста. Попробуйте еще раз.",
+    "voice": "Произошла ошибка при обработке голосового сообщения. Попробуйте еще раз.",
+}
+
+async def get_registered_user(update: Update, source: str) -> Optional[dict]:
+    """Профиль пользователя; незарегистрированному отправляется подсказка"""
+    user = await asyncio.to_thread(db.get_user, update.effective_user.id)
+    if not user:
+        logger.warning("Unregistered user %s tried to analyze %s", update.effective_user.id, source)
+        await update.message.reply_text("❌ Сначала пройдите регистрацию командой /start")
+    return user
+
+def pop_quick_mode(context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Флаг быстрого анализа действует на одно сообщение"""
+    return bool(context.user_data.pop('quick_analysis_mode', False))
+
+async def build_food_result(update: Update, user: dict, meal_type: str, source: str, result: str, save: bool) -> str:
+    """Текст результата: быстрый анализ без сохранения либо запись в историю и сумма за день"""
+    if not save:
+        return QUICK_ANALYSIS_RESULT.format(result=result)
+    
+    # Извлекаем количество калорий из результата
+    calories = extract_calories_from_text(result)
+    if not calories:
+        logger.warning("Could not extract calories from %s analysis result: %s", source, result)
+        return result
+    
+    # Сохраняем в историю
+    user_id = update.effective_user.id
+    if not await calorie_writer.add(user_id, meal_type, calories, source):
+        # Транзакция пакета не зафиксирована: сумма за день не включала бы эту запись
+        logger.error("Failed to save %s analysis: %s calories for user %s", source, calories, user_id)
+        return PROCESSING_ERROR_MESSAGES[source]
+    logger.info("Saved %s analysis: %s calories for user %s", source, calories, user_id)
+    
+    # Сумма калорий за сегодня уже учитывает новую запись
+    daily_sum = await asyncio.to_thread(db.get_daily_calories_sum, user_id)
+    return format_calorie_response(calories, daily_sum, user.get('daily_calories', 0))
+
+async def process_food_entry(update: Update, context: ContextTypes.DEFAULT_TYPE, user: dict,
+                             source: str, analysis: Awaitable[str], save: bool) -> None:
+    """Общий путь фото и текста: сообщение о начале, анализ, сохранение и ответ с меню"""
+    meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
+    status_text = ANALYSIS_STATUS_MESSAGES[(source, not save)].format(meal_type=meal_type)
+    
+    # Анализ идет параллельно с сообщением о начале анализа
+    result, _ = await asyncio.gather(analysis, update.message.reply_text(status_text))
+    
+    result_text = await build_food_result(update, user, meal_type, source, result, save)
+    await reply_with_analysis_menu(update.message, result_text, parse_mode=None if save else 'Markdown')
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик фотографий"""
+    user_id = update.effective_user.id
+    quick = False
     try:
-        user_id = update.effective_user.id
-        username = update.effective_user.username or "unknown"
-        
-        logger.info(f"User {user_id} ({username}) sent photo for analysis")
-        
-        # Проверяем, зарегистрирован ли пользователь
-        user = db.get_user(user_id)
-        if not user:
-            logger.warning(f"Unregistered user {user_id} tried to analyze photo")
-            await update.message.reply_text("❌ Сначала пройдите регистрацию командой /start")
-            return
-        
-        # Проверяем режим быстрого анализа
-        if context.user_data.get('quick_analysis_mode'):
-            context.user_data['quick_analysis_mode'] = False  # Сбрасываем флаг
-            logger.info(f"User {user_id} using quick analysis mode for photo")
-            await handle_quick_photo(update, context)
-            return
-        
-        # Получаем информацию о фотографии
-        photo = update.message.photo[-1]  # Берем фото в наилучшем качестве
-        
-        # Скачиваем изображение
-        file = await context.bot.get_file(photo.file_id)
-        image_data = await file.download_as_bytearray()
-        
-        # Получаем выбранный тип приема пищи
-        meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
-        logger.info(f"Analyzing photo for {meal_type} for user {user_id}")
-        
-        # Отправляем сообщение о начале анализа
-        await update.message.reply_text(f"Анализирую изображение для {meal_type}...")
-        
-        # Анализируем изображение
-        result = analyze_food_image(image_data)
-        
-        # Извлекаем количество калорий из результата
-        calories = extract_calories_from_text(result)
-        if calories:
-            # Получаем выбранный тип приема пищи
-            meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
-            # Сохраняем в историю
-            db.add_calorie_record(user_id, meal_type, calories, "photo")
-            logger.info(f"Saved photo analysis: {calories} calories for user {user_id}")
-            
-            # Получаем общую сумму калорий за сегодня
-            daily_sum = db.get_daily_calories_sum(user_id)
-            daily_calories = user.get('daily_calories', 0)
-            
-            # Формируем ответ
-            result = format_calorie_response(calories, daily_sum, daily_calories)
-        else:
-            logger.warning(f"Could not extract calories from photo analysis result: {result}")
-        
-        # Отправляем результат
-        await update.message.reply_text(result)
-        
-        # Показываем меню для нового запроса
-        await show_analysis_menu(update, context)
-        
-    except Exception as e:
-        logger.error(f"Error handling photo for user {user_id}: {e}")
-        await update.message.reply_text("Произошла ошибка при обработке фотографии. Попробуйте еще раз.")
-
-async def handle_quick_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик текстовых сообщений для быстрого анализа (без сохранения в дневной расчет)"""
-    try:
-        text = update.message.text
-        user_id = update.effective_user.id
-        
-        # Проверяем, идет ли процесс регистрации
-        if 'registration_step' in context.user_data:
-            await handle_registration_text(update, context, text)
-            return
+        logger.info("User %s (%s) sent photo for analysis", user_id, update.effective_user.username or "unknown")
         
         # Проверяем, зарегистрирован ли пользователь
-        user = db.get_user(user_id)
+        user = await get_registered_user(update, "photo")
         if not user:
-            await update.message.reply_text("❌ Сначала пройдите регистрацию командой /start")
             return
         
-        # Отправляем сообщение о начале анализа
-        await update.message.reply_text("🔍 Анализирую описание для быстрого анализа...")
-        
-        # Анализируем текст
-        result = analyze_food_text(text)
-        
-        # Отправляем результат без сохранения в историю
-        await update.message.reply_text(f"🔍 **Быстрый анализ калорий**\n\n{result}\n\n💡 Результат не сохранен в дневной расчет", parse_mode='Markdown')
+        # В режиме быстрого анализа результат не сохраняется в дневной расчет
+        quick = pop_quick_mode(context)
         
-        # Показываем меню для следующего действия
-        await show_analysis_menu(update, context)
+        # Фото в наилучшем качестве; анализ стартует сразу после скачивания
+        await process_food_entry(
+            update, context, user, "photo",
+            download_and_analyze_photo(context, update.message.photo[-1]),
+            save=not quick
+        )
         
     except Exception as e:
-        logger.error(f"Error in quick text analysis: {e}")
-        await update.message.reply_text("❌ Извините, не удалось проанализировать описание. Попробуйте еще раз.")
+        logger.error("Error handling photo for user %s: %s", user_id, e)
+        await update.message.reply_text(
+            "❌ Извините, не удалось проанализировать изображение. Попробуйте еще раз." if quick
+            else PROCESSING_ERROR_MESSAGES["photo"]
+        )
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик текстовых сообщений"""
+    quick = False
     try:
         text = update.message.text
-        user_id = update.effective_user.id
         
         # Проверяем, идет ли процесс регистрации
         if 'registration_step' in context.user_data:
@@ -801,181 +784,130 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             return
         
         # Проверяем, зарегистрирован ли пользователь
-        user = db.get_user(user_id)
+        user = await get_registered_user(update, "text")
         if not user:
-            await update.message.reply_text("❌ Сначала пройдите регистрацию командой /start")
-            return
-        
-        # Проверяем режим быстрого анализа
-        if context.user_data.get('quick_analysis_mode'):
-            context.user_data['quick_analysis_mode'] = False  # Сбрасываем флаг
-            await handle_quick_text(update, context)
             return
         
-        # Получаем выбранный тип приема пищи
-        meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
-        # Отправляем сообщение о начале анализа
-        await update.message.reply_text(f"Анализирую описание для {meal_type}...")
-        
-        # Анализируем текст
-        result = analyze_food_text(text)
-        
-        # Извлекаем количество калорий из результата
-        calories = extract_calories_from_text(result)
-        if calories:
-            # Получаем выбранный тип приема пищи
-            meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
-            # Сохраняем в историю
-            db.add_calorie_record(user_id, meal_type, calories, "text")
-            
-            # Получаем общую сумму калорий за сегодня
-            daily_sum = db.get_daily_calories_sum(user_id)
-            daily_calories = user.get('daily_calories', 0)
-            
-            # Формируем ответ
-            result = format_calorie_response(calories, daily_sum, daily_calories)
-        else:
-            logger.warning(f"Could not extract calories from result: {result}")
+        # В режиме быстрого анализа результат не сохраняется в дневной расчет
+        quick = pop_quick_mode(context)
         
-        # Отправляем результат
-        await update.message.reply_text(result)
-        
-        # Показываем меню для нового запроса
-        await show_analysis_menu(update, context)
+        analysis = analyze_food_text(text)
+        await process_food_entry(update, context, user, "text", analysis, save=not quick)
         
     except Exception as e:
-        logger.error(f"Error handling text: {e}")
-        await update.message.reply_text("Произошла ошибка при обработке текста. Попробуйте еще раз.")
+        logger.error("Error handling text: %s", e)
+        await update.message.reply_text(
+            "❌ Извините, не удалось проанализировать описание. Попробуйте еще раз." if quick
+            else PROCESSING_ERROR_MESSAGES["text"]
+        )
 
-async def handle_registration_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
-    """Обработка текста во время регистрации"""
-    step = context.user_data.get('registration_step')
-    user_data = context.user_data.get('registration_data', {})
+async def _register_name(update: Update, user_state: dict, user_data: dict, text: str) -> None:
+    """Шаг регистрации: имя"""
+    user_data['name'] = text
+    user_state['registration_step'] = 'gender'
     
-    if step == 'name':
-        user_data['name'] = text
-        context.user_data['registration_step'] = 'gender'
-        
-        keyboard = [
-            [InlineKeyboardButton("Мужской", callback_data="gender_male")],
-            [InlineKeyboardButton("Женский", callback_data="gender_female")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text(
+        f"Приятно познакомиться, {text}!\n\n"
+        "Выберите ваш пол:",
+        reply_markup=GENDER_MARKUP
+    )
+
+async def _register_age(update: Update, user_state: dict, user_data: dict, text: str) -> None:
+    """Шаг регистрации: возраст"""
+    age = validate_user_input(text, "age")
+    if age is not None:
+        user_data['age'] = age
+        user_state['registration_step'] = 'height'
+        await update.message.reply_text("Введите ваш рост в сантиметрах:")
+    else:
+        await update.message.reply_text("Пожалуйста, введите корректный возраст (10-120 лет):")
+
+async def _register_height(update: Update, user_state: dict, user_data: dict, text: str) -> None:
+    """Шаг регистрации: рост"""
+    height = validate_user_input(text, "height")
+    if height is not None:
+        user_data['height'] = height
+        user_state['registration_step'] = 'weight'
+        await update.message.reply_text("Введите ваш вес в килограммах:")
+    else:
+        await update.message.reply_text("Пожалуйста, введите корректный рост (100-250 см):")
+
+async def _register_weight(update: Update, user_state: dict, user_data: dict, text: str) -> None:
+    """Шаг регистрации: вес"""
+    weight = validate_user_input(text, "weight")
+    if weight is not None:
+        user_data['weight'] = weight
+        user_state['registration_step'] = 'activity'
         
         await update.message.reply_text(
-            f"Приятно познакомиться, {text}!\n\n"
-            "Выберите ваш пол:",
-            reply_markup=reply_markup
+            "🏃‍♂️ **Выберите уровень вашей физической активности:**\n\n"
+            "Это поможет точно рассчитать вашу суточную норму калорий.\n"
+            "Выберите тот вариант, который лучше всего описывает ваш образ жизни:",
+            reply_markup=ACTIVITY_MARKUP,
+            parse_mode='Markdown'
         )
-    
-    elif step == 'age':
-        age = validate_user_input(text, "age")
-        if age is not None:
-            user_data['age'] = age
-            context.user_data['registration_step'] = 'height'
-            await update.message.reply_text("Введите ваш рост в сантиметрах:")
-        else:
-            await update.message.reply_text("Пожалуйста, введите корректный возраст (10-120 лет):")
-    
-    elif step == 'height':
-        height = validate_user_input(text, "height")
-        if height is not None:
-            user_data['height'] = height
-            context.user_data['registration_step'] = 'weight'
-            await update.message.reply_text("Введите ваш вес в килограммах:")
-        else:
-            await update.message.reply_text("Пожалуйста, введите корректный рост (100-250 см):")
-    
-    elif step == 'weight':
-        weight = validate_user_input(text, "weight")
-        if weight is not None:
-            user_data['weight'] = weight
-            context.user_data['registration_step'] = 'activity'
-            
-            keyboard = [
-                [InlineKeyboardButton("🏢 Сидячая работа (офис, учеба)", callback_data="activity_sedentary")],
-                [InlineKeyboardButton("🚶 Легкая активность (прогулки, домашние дела)", callback_data="activity_light")],
-                [InlineKeyboardButton("🏃 Умеренная активность (спорт 3-5 раз/неделю)", callback_data="activity_moderate")],
-                [InlineKeyboardButton("💪 Высокая активность (спорт 6-7 раз/неделю)", callback_data="activity_high")],
-                [InlineKeyboardButton("🏗️ Физическая работа (строительство, грузчик)", callback_data="activity_very_high")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text(
-                "🏃‍♂️ **Выберите уровень вашей физической активности:**\n\n"
-                "Это поможет точно рассчитать вашу суточную норму калорий.\n"
-                "Выберите тот вариант, который лучше всего описывает ваш образ жизни:",
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
-        else:
-            await update.message.reply_text("Пожалуйста, введите корректный вес (30-300 кг):")
-    
+    else:
+        await update.message.reply_text("Пожалуйста, введите корректный вес (30-300 кг):")
+
+# Текстовые шаги регистрации: шаг -> обработчик (пол и активность выбираются кнопками)
+REGISTRATION_STEP_HANDLERS = {
+    'name': _register_name,
+    'age': _register_age,
+    'height': _register_height,
+    'weight': _register_weight,
+}
+
+async def handle_registration_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
+    """Обработка текста во время регистрации"""
+    user_state = context.user_data
+    step_handler = REGISTRATION_STEP_HANDLERS.get(user_state.get('registration_step'))
+    if step_handler is not None:
+        await step_handler(update, user_state, user_state.get('registration_data', {}), text)
 
 async def complete_registration(update: Update, context: ContextTypes.DEFAULT_TYPE, user_data: dict):
     """Завершение регистрации"""
     try:
-        # Добавляем детальное логирование для отладки
-        logger.info(f"Complete registration - user_data: {user_data}")
-        
-        # Логируем параметры для расчета калорий
+        # Параметры для расчета калорий
         gender = user_data.get('gender')
         age = user_data.get('age')
         height = user_data.get('height')
         weight = user_data.get('weight')
         activity_level = user_data.get('activity_level')
         
-        logger.info(f"Complete registration - gender: {repr(gender)}")
-        logger.info(f"Complete registration - age: {repr(age)}")
-        logger.info(f"Complete registration - height: {repr(height)}")
-        logger.info(f"Complete registration - weight: {repr(weight)}")
-        logger.info(f"Complete registration - activity_level: {repr(activity_level)}")
-        logger.info(f"Complete registration - activity_level type: {type(activity_level)}")
+        logger.debug("Complete registration - user_data: %s", user_data)
         
         # Рассчитываем суточные калории
         daily_calories = db.calculate_daily_calories(
             gender, age, height, weight, activity_level
         )
         
-        logger.info(f"Complete registration - calculated daily_calories: {daily_calories}")
+        logger.info("Complete registration - calculated daily_calories: %s", daily_calories)
         
         user_data['daily_calories'] = daily_calories
         
         # Сохраняем пользователя в базу данных
-        if db.add_user(user_data):
+        if await asyncio.to_thread(db.add_user, user_data):
             # Очищаем данные регистрации
             context.user_data.pop('registration_step', None)
             context.user_data.pop('registration_data', None)
             
-            keyboard = [
-                [InlineKeyboardButton("🍕 Начать анализ еды", callback_data="back_to_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
             await update.message.reply_text(
                 f"🎉 Регистрация завершена!\n\n"
                 f"Ваша суточная норма калорий: {daily_calories} ккал\n\n"
                 f"Теперь я смогу сравнивать калории в еде с вашей нормой!",
-                reply_markup=reply_markup
+                reply_markup=START_ANALYSIS_MARKUP
             )
         else:
             await update.message.reply_text("❌ Ошибка при сохранении данных. Попробуйте еще раз.")
     
     except Exception as e:
-        logger.error(f"Error completing registration: {e}")
+        logger.error("Error completing registration: %s", e)
         await update.message.reply_text("❌ Произошла ошибка при завершении регистрации. Попробуйте еще раз.")
 
 async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /reset"""
     user_id = update.effective_user.id
     
-    # Создаем кнопки подтверждения
-    keyboard = [
-        [InlineKeyboardButton("✅ Да, сбросить все данные", callback_data="confirm_reset")],
-        [InlineKeyboardButton("❌ Отмена", callback_data="cancel_reset")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
         "⚠️ ВНИМАНИЕ!\n\n"
         "Вы собираетесь удалить ВСЕ ваши данные:\n"
@@ -984,40 +916,31 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         "• Настройки и предпочтения\n\n"
         "Это действие НЕЛЬЗЯ отменить!\n\n"
         "Вы уверены, что хотите продолжить?",
-        reply_markup=reply_markup
+        reply_markup=RESET_CONFIRM_MARKUP
     )
 
 async def dayres_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /dayres - сброс дневных данных"""
+    user_state = context.user_data
     user_id = update.effective_user.id
     
     # Проверяем, зарегистрирован ли пользователь
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
     if not user:
         await update.message.reply_text("❌ Сначала пройдите регистрацию командой /start")
         return
     
     # Сбрасываем дневные данные пользователя
-    context.user_data['selected_meals_today'] = set()
-    context.user_data['daily_calories_sum'] = 0
-    context.user_data['last_reset_date'] = None  # Сбрасываем дату, чтобы при следующем взаимодействии снова сработал сброс
+    user_state['selected_meals_mask'] = 0
+    user_state['last_reset_date'] = None  # Сбрасываем дату, чтобы при следующем взаимодействии снова сработал сброс
     
     # Сбрасываем калории за сегодняшний день в базе данных
-    success = db.reset_daily_calories(user_id)
+    success = await asyncio.to_thread(db.reset_daily_calories, user_id)
     
     # Получаем текущую дату для логирования
-    from datetime import date
-    current_date = date.today()
+    current_date = db.today()
     
-    logger.info(f"Daily reset for user {user_id} on {current_date}")
-    
-    # Создаем кнопки для возврата в меню
-    keyboard = [
-        [InlineKeyboardButton("🍽️ Добавить блюдо", callback_data="add_food")],
-        [InlineKeyboardButton("🔍 Быстрый анализ", callback_data="quick_analysis")],
-        [InlineKeyboardButton("📋 Меню", callback_data="main_menu_submenu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    logger.info("Daily reset for user %s on %s", user_id, current_date)
     
     if success:
         await update.message.reply_text(
@@ -1027,7 +950,7 @@ async def dayres_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "• Все записи калорий за сегодняшний день\n"
             "• Счетчик калорий за день\n\n"
             "Теперь вы можете заново добавить завтрак, обед и ужин!",
-            reply_markup=reply_markup,
+            reply_markup=DAYRES_MENU_MARKUP,
             parse_mode='Markdown'
         )
     else:
@@ -1038,7 +961,7 @@ async def dayres_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "• Счетчик калорий за день\n\n"
             "❌ Не удалось сбросить записи калорий из базы данных.\n"
             "Попробуйте еще раз или обратитесь к администратору.",
-            reply_markup=reply_markup,
+            reply_markup=DAYRES_MENU_MARKUP,
             parse_mode='Markdown'
         )
 
@@ -1048,20 +971,15 @@ async def confirm_reset(query, context):
     
     try:
         # Сбрасываем все данные пользователя
-        if db.reset_user_data(user_id):
+        if await asyncio.to_thread(db.reset_user_data, user_id):
             # Очищаем данные регистрации из контекста
             context.user_data.clear()
             
-            keyboard = [
-                [InlineKeyboardButton("🔄 Начать заново", callback_data="start_registration")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
             await query.edit_message_text(
                 "✅ Все данные успешно удалены!\n\n"
                 "Ваш профиль, история калорий и все настройки были сброшены.\n\n"
                 "Нажмите кнопку ниже, чтобы начать регистрацию заново:",
-                reply_markup=reply_markup
+                reply_markup=RESTART_REGISTRATION_MARKUP
             )
         else:
             await query.edit_message_text(
@@ -1069,7 +987,7 @@ async def confirm_reset(query, context):
             )
     
     except Exception as e:
-        logger.error(f"Error confirming reset: {e}")
+        logger.error("Error confirming reset: %s", e)
         await query.edit_message_text(
             "❌ Произошла ошибка при сбросе данных. Попробуйте еще раз."
         )
@@ -1077,7 +995,7 @@ async def confirm_reset(query, context):
 async def cancel_reset(query, context):
     """Отмена сброса данных"""
     user_id = query.from_user.id
-    user = db.get_user(user_id)
+    user = await asyncio.to_thread(db.get_user, user_id)
     
     if user:
         # Возвращаемся в главное меню
@@ -1086,154 +1004,151 @@ async def cancel_reset(query, context):
         # Если пользователь не зарегистрирован, показываем приветствие
         await start_registration(query, context)
 
-async def handle_quick_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработчик голосовых сообщений для быстрого анализа (без сохранения в дневной расчет)"""
-    try:
-        user_id = update.effective_user.id
-        
-        # Проверяем, зарегистрирован ли пользователь
-        user = db.get_user(user_id)
-        if not user:
-            await update.message.reply_text("❌ Сначала пройдите регистрацию командой /start")
-            return
-        
-        # Получаем информацию о голосовом сообщении
-        voice = update.message.voice
-        
-        # Скачиваем аудио
-        file = await context.bot.get_file(voice.file_id)
-        audio_data = await file.download_as_bytearray()
-        
-        # Отправляем сообщение о начале обработки
-        await update.message.reply_text("🔍 Обрабатываю голосовое сообщение для быстрого анализа...")
-        
-        # Транскрибируем голос в текст
-        text = transcribe_voice(audio_data)
-        
-        if text:
-            await update.message.reply_text(f"Распознанный текст: {text}")
-            await update.message.reply_text("🔍 Анализирую описание для быстрого анализа...")
-            
-            # Анализируем текст
-            result = analyze_food_text(text)
-            
-            # Отправляем результат без сохранения в историю
-            await update.message.reply_text(f"🔍 **Быстрый анализ калорий**\n\n{result}\n\n💡 Результат не сохранен в дневной расчет", parse_mode='Markdown')
-            
-            # Показываем меню для следующего действия
-            await show_analysis_menu(update, context)
-        else:
-            await update.message.reply_text("❌ Не удалось распознать речь. Попробуйте еще раз.")
-            
-    except Exception as e:
-        logger.error(f"Error in quick voice analysis: {e}")
-        await update.message.reply_text("❌ Извините, не удалось обработать голосовое сообщение. Попробуйте еще раз.")
-
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик голосовых сообщений"""
+    quick = False
     try:
-        user_id = update.effective_user.id
-        
         # Проверяем, зарегистрирован ли пользователь
-        user = db.get_user(user_id)
+        user = await get_registered_user(update, "voice")
         if not user:
-            await update.message.reply_text("❌ Сначала пройдите регистрацию командой /start")
             return
         
-        # Проверяем режим быстрого анализа
-        if context.user_data.get('quick_analysis_mode'):
-            context.user_data['quick_analysis_mode'] = False  # Сбрасываем флаг
-            await handle_quick_voice(update, context)
+        # В режиме быстрого анализа результат не сохраняется в дневной расчет
+        # Флаг снимается и при отключенном распознавании, иначе он перейдет на следующее сообщение
+        quick = pop_quick_mode(context)
+        if not speech_client.enabled:
+            await update.message.reply_text(
+                "🎤 Распознавание голосовых сообщений сейчас недоступно. Опишите блюдо текстом или отправьте фото."
+            )
             return
+        meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
         
-        # Получаем информацию о голосовом сообщении
-        voice = update.message.voice
+        # Весь ход обработки показываем в одном сообщении, редактируя его;
+        # распознавание стартует сразу после скачивания, не дожидаясь ответа Telegram
+        text, status = await asyncio.gather(
+            download_and_transcribe(context, update.message.voice),
+            update.message.reply_text(ANALYSIS_STATUS_MESSAGES[("voice", quick)])
+        )
         
-        # Скачиваем аудио
-        file = await context.bot.get_file(voice.file_id)
-        audio_data = await file.download_as_bytearray()
+        if not text:
+            await status.edit_text(
+                "❌ Не удалось распознать речь. Попробуйте еще раз." if quick
+                else "Не удалось распознать речь. Попробуйте еще раз или используйте текстовое описание."
+            )
+            return
         
-        # Отправляем сообщение о начале обработки
-        await update.message.reply_text("Обрабатываю голосовое сообщение...")
+        # Ответ быстрого анализа в Markdown: распознанный текст экранируем
+        parse_mode = 'Markdown' if quick else None
+        recognized = f"Распознанный текст: {escape_markdown(text) if quick else text}"
+        analyzing = ANALYSIS_STATUS_MESSAGES[("text", quick)].format(meal_type=meal_type)
         
-        # Транскрибируем голос в текст
-        text = transcribe_voice(audio_data)
+        # Анализируем текст, пока обновляется статус
+        result, _ = await asyncio.gather(
+            analyze_food_text(text),
+            status.edit_text(f"{recognized}\n\n{analyzing}", parse_mode=parse_mode)
+        )
         
-        if text:
-            await update.message.reply_text(f"Распознанный текст: {text}")
-            # Получаем выбранный тип приема пищи
-            meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
-            await update.message.reply_text(f"Анализирую описание для {meal_type}...")
-            
-            # Анализируем текст
-            result = analyze_food_text(text)
-            
-            # Извлекаем количество калорий из результата
-            calories = extract_calories_from_text(result)
-            if calories:
-                # Получаем выбранный тип приема пищи
-                meal_type = context.user_data.get('selected_meal_type', '🍽️ Блюдо')
-                # Сохраняем в историю
-                db.add_calorie_record(user_id, meal_type, calories, "voice")
-                
-                # Получаем общую сумму калорий за сегодня
-                daily_sum = db.get_daily_calories_sum(user_id)
-                daily_calories = user.get('daily_calories', 0)
-                
-                # Формируем ответ
-                result = format_calorie_response(calories, daily_sum, daily_calories)
-            else:
-                logger.warning(f"Could not extract calories from result: {result}")
-            
-            # Отправляем результат
-            await update.message.reply_text(result)
-            
-            # Показываем меню для нового запроса
-            await show_analysis_menu(update, context)
-        else:
-            await update.message.reply_text("Не удалось распознать речь. Попробуйте еще раз или используйте текстовое описание.")
+        # Показываем результат в том же сообщении вместе с меню для нового запроса
+        result_text = await build_food_result(update, user, meal_type, "voice", result, save=not quick)
+        await status.edit_text(
+            f"{recognized}\n\n{result_text}\n\n{ANALYSIS_MENU_PROMPT}",
+            reply_markup=MAIN_MENU_MARKUP,
+            parse_mode=parse_mode
+        )
         
     except Exception as e:
-        logger.error(f"Error handling voice: {e}")
-        await update.message.reply_text("Произошла ошибка при обработке голосового сообщения. Попробуйте еще раз.")
+        logger.error("Error handling voice: %s", e)
+        await update.message.reply_text(
+            "❌ Извините, не удалось обработать голосовое сообщение. Попробуйте еще раз." if quick
+            else PROCESSING_ERROR_MESSAGES["voice"]
+        )
+
+# Обработчики кнопок: callback_data -> обработчик(query, context)
+CALLBACK_HANDLERS = {
+    "start_registration": start_registration_flow,
+    "edit_profile": start_registration_flow,
+    **{data: show_add_food_prompt for data in ADD_FOOD_PROMPTS},
+    **{data: show_quick_analysis_prompt for data in QUICK_ANALYSIS_PROMPTS},
+    **{data: handle_meal_selection for data in MEAL_CALLBACKS},
+    "profile": show_profile,
+    "history": show_calorie_history_menu,
+    "history_today": partial(show_calorie_history, period="today"),
+    "history_yesterday": partial(show_calorie_history, period="yesterday"),
+    "history_week": partial(show_calorie_history, period="week"),
+    "back_to_main": show_main_menu,
+    "add_food": show_meal_type_menu,
+    "meal_type": show_meal_type_menu,
+    "quick_analysis": show_quick_analysis_menu,
+    "main_menu_submenu": show_main_menu_submenu,
+    "confirm_reset": confirm_reset,
+    "cancel_reset": cancel_reset
+}
+# Кнопки с параметром в callback_data: префикс до "_" -> обработчик
+CALLBACK_PREFIX_HANDLERS = {
+    "gender": handle_gender_selection,
+    "activity": handle_activity_selection
+}
+
+async def on_startup(application: Application) -> None:
+    """Создание таблиц и прогрев клиента API до первого сообщения пользователя"""
+    await asyncio.to_thread(db.init_database)
+    await api_client.warm_up()
+
+async def on_shutdown(application: Application) -> None:
+    """Освобождение ресурсов при остановке бота"""
+    await api_client.close()
+    await speech_client.close()
+    stt_executor.shutdown(wait=False)
+    await calorie_writer.close()
+    db.close()
+    if diskcache is not None and isinstance(api_cache, diskcache.Cache):
+        api_cache.close()
 
-async def main() -> None:
+# Текстовые сообщения, кроме команд (фильтр собирается один раз)
+TEXT_MESSAGE_FILTER = filters.TEXT & ~filters.COMMAND
+
+# Обработчики обновлений в порядке проверки
+HANDLERS = (
+    CommandHandler("start", start),
+    CommandHandler("reset", reset_command),
+    CommandHandler("dayres", dayres_command),
+    CallbackQueryHandler(button_callback),
+    MessageHandler(filters.PHOTO, handle_photo),
+    MessageHandler(TEXT_MESSAGE_FILTER, handle_text),
+    MessageHandler(filters.VOICE, handle_voice),
+)
+
+def main() -> None:
     """Запуск бота"""
+    if sf is None:
+        logger.warning("soundfile not available, voice messages will be decoded with ffmpeg")
+    if not speech_client.enabled:
+        logger.warning("GOOGLE_SPEECH_API_KEY not set, voice messages are disabled")
+    
     # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = Application.builder().token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown)
+    # Разные чаты обрабатываются параллельно, сообщения одного чата - по порядку
+    builder = builder.concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES_PER_CHAT))
+    if BOT_STATE_PATH:
+        # Сохраняем только user_data: после перезапуска пользователи продолжают с того же места
+        builder = builder.persistence(PicklePersistence(
+            filepath=BOT_STATE_PATH,
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False)
+        ))
+    try:
+        # Исходящие запросы укладываются в лимиты Telegram (30 сообщений/с на бота,
+        # 20 в минуту на группу) вместо ошибок 429 при всплесках; RetryAfter повторяется
+        builder = builder.rate_limiter(AIORateLimiter(max_retries=TELEGRAM_RATE_LIMIT_RETRIES))
+    except RuntimeError:
+        logger.warning("aiolimiter not available, outgoing Telegram requests are not rate limited")
+    application = builder.build()
 
     # Добавляем обработчики
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("reset", reset_command))
-    application.add_handler(CommandHandler("dayres", dayres_command))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    application.add_handler(MessageHandler(filters.VOICE, handle_voice))
-
-    # Запускаем бота
-    print("Бот запущен...")
-    print("Автоматический сброс приемов пищи при первом взаимодействии нового дня")
-    await application.run_polling()
+    application.add_handlers(HANDLERS)
+
+    # Запускаем бота: run_polling сам создает event loop и управляет им до остановки
+    logger.info("Bot started, daily meals reset on the first interaction of a new day")
+    application.run_polling()
 
 if __name__ == '__main__':
-    try:
-        # Попробуем запустить с asyncio.run()
-        asyncio.run(main())
-    except RuntimeError as e:
-        if "This event loop is already running" in str(e) or "Cannot close a running event loop" in str(e):
-            # Если event loop уже запущен, используем другой подход
-            try:
-                import nest_asyncio
-                nest_asyncio.apply()
-                asyncio.run(main())
-            except ImportError:
-                # Если nest_asyncio не установлен, используем альтернативный метод
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    # Создаем новую задачу в существующем loop
-                    loop.create_task(main())
-                else:
-                    loop.run_until_complete(main())
-        else:
-            raise e
+    main()
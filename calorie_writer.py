@@ -0,0 +1,91 @@
+"""
+Пакетная запись истории калорий: вставки от разных пользователей группируются в одну транзакцию
+"""
+import asyncio
+import logging
+from typing import List, Optional, Set, Tuple
+from config import DB_WRITE_BATCH_WINDOW, DB_WRITE_BATCH_MAX_SIZE
+from database import UserDatabase
+
+logger = logging.getLogger(__name__)
+
+class CalorieRecordWriter:
+    """Очередь записей о калориях с фоновым сбросом пакетами"""
+    
+    def __init__(self, db: UserDatabase):
+        self._db = db
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flushes: Set[asyncio.Task] = set()
+    
+    async def _flush(self, batch: List[Tuple[Tuple[int, str, int, str], asyncio.Future]]) -> None:
+        """Запись пакета одной транзакцией в потоке, чтобы не блокировать event loop"""
+        try:
+            success = await asyncio.to_thread(self._db.add_calorie_records, [record for record, _ in batch])
+        except Exception as e:
+            logger.error("Error flushing calorie records: %s", e)
+            success = False
+        if len(batch) > 1:
+            logger.info("Flushed %d calorie records in one transaction", len(batch))
+        
+        # Ожидающие обработчики продолжают только после commit: сумма за день уже учитывает запись
+        for _, future in batch:
+            if not future.done():
+                future.set_result(success)
+    
+    async def _flusher(self) -> None:
+        """Сбор записей в пакеты: до DB_WRITE_BATCH_MAX_SIZE штук или DB_WRITE_BATCH_WINDOW секунд"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + DB_WRITE_BATCH_WINDOW
+            while len(batch) < DB_WRITE_BATCH_MAX_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    # Сигнал остановки из close: собранный пакет все равно записывается
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            # Пакет пишется в фоне, сбор следующего начинается сразу
+            task = asyncio.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+    
+    async def add(self, user_id: int, food_name: str, calories: int, source: str = "unknown") -> bool:
+        """Постановка записи в очередь; возвращает результат после фиксации транзакции"""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._flusher())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(((user_id, food_name, calories, source), future))
+        return await future
+    
+    async def close(self) -> None:
+        """Остановка сборщика с записью того, что осталось в очереди"""
+        if self._task is not None:
+            # Сборщик не отменяется: иначе пропал бы пакет, который он собирает в этот момент
+            if not self._task.done():
+                self._queue.put_nowait(None)
+                await self._task
+            self._task = None
+        
+        pending = []
+        while self._queue is not None and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                pending.append(item)
+        if pending:
+            await self._flush(pending)
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
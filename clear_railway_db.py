@@ -6,6 +6,14 @@
 import os
 import sys
 
+def count_rows(cursor):
+    """Количество пользователей и записей калорий"""
+    cursor.execute("SELECT COUNT(*) FROM users;")
+    users_count = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM calorie_history;")
+    records_count = cursor.fetchone()[0]
+    return users_count, records_count
+
 def clear_railway_database():
     """Очистка базы данных на Railway через API или прямые команды"""
     print("🌐 Очистка базы данных на Railway...")
@@ -23,36 +31,36 @@ def clear_railway_database():
         from database import UserDatabase
         
         db = UserDatabase()
-        
-        # Получаем статистику
-        stats = db.get_database_stats()
-        print(f"Пользователей: {stats.get('users_count', 0)}")
-        print(f"Записей калорий: {stats.get('records_count', 0)}")
+        db.init_database()
         
         # Очищаем все данные
         with db.get_connection() as conn:
             cursor = conn.cursor()
             
-            # Удаляем записи калорий
-            cursor.execute("DELETE FROM calorie_history;")
-            deleted_calories = cursor.rowcount
-            print(f"✅ Удалено записей калорий: {deleted_calories}")
+            # Получаем статистику
+            users_count, records_count = count_rows(cursor)
+            print(f"Пользователей: {users_count}")
+            print(f"Записей калорий: {records_count}")
             
-            # Удаляем пользователей
-            cursor.execute("DELETE FROM users;")
-            deleted_users = cursor.rowcount
-            print(f"✅ Удалено пользователей: {deleted_users}")
-            
-            # Сбрасываем последовательности для PostgreSQL
             if db.use_postgres:
-                cursor.execute("ALTER SEQUENCE calorie_history_id_seq RESTART WITH 1;")
+                # TRUNCATE освобождает таблицы целиком, без построчного удаления,
+                # и сразу сбрасывает последовательности
+                cursor.execute("TRUNCATE calorie_history, users RESTART IDENTITY CASCADE;")
                 print("✅ Последовательности сброшены")
+            else:
+                cursor.execute("DELETE FROM calorie_history;")
+                cursor.execute("DELETE FROM users;")
+                cursor.execute("DELETE FROM sqlite_sequence WHERE name IN ('calorie_history', 'users');")
+            print(f"✅ Удалено записей калорий: {records_count}")
+            print(f"✅ Удалено пользователей: {users_count}")
             
             conn.commit()
+            
+            # Проверяем результат
+            final_users, final_records = count_rows(cursor)
         
-        # Проверяем результат
-        final_stats = db.get_database_stats()
-        if final_stats.get('users_count', 0) == 0 and final_stats.get('records_count', 0) == 0:
+        db.close()
+        if final_users == 0 and final_records == 0:
             print("🎉 База данных на Railway полностью очищена!")
             return True
         else:
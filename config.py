@@ -21,12 +21,66 @@ if not NEBUS_API_KEY:
 
 # Настройки базы данных
 DATABASE_PATH = "users.db"
+# Файл с context.user_data (выбранный прием пищи, шаг регистрации и т.п.),
+# чтобы состояние пользователей переживало перезапуск; пустое значение отключает
+BOT_STATE_PATH = os.getenv("BOT_STATE_PATH", "bot_state.pkl")
+
+# Повторы запроса к Telegram после ответа RetryAfter (превышен лимит сообщений)
+TELEGRAM_RATE_LIMIT_RETRIES = 2
+# Сколько обновлений обрабатывается одновременно (в пределах чата - по одному)
+MAX_CONCURRENT_UPDATES = 256
+# Сколько обновлений одного чата может ждать очереди; лишние отклоняются,
+# чтобы один чат не занял весь лимит MAX_CONCURRENT_UPDATES
+MAX_PENDING_UPDATES_PER_CHAT = 5
 
 # Настройки API
 API_TIMEOUT = 30
+# Соединения с API держим открытыми и ограничиваем их число: запросы сверх лимита
+# ждут свободное keep-alive соединение вместо нового TLS-рукопожатия
+API_MAX_CONNECTIONS = 16
+API_KEEPALIVE_TIMEOUT = 60  # секунд
+API_MODEL = "Qwen/Qwen2.5-VL-72B-Instruct"
+# Резервная VL-модель: запрашивается параллельно с основной, берется первый ответ
+API_FALLBACK_MODEL = os.getenv("API_FALLBACK_MODEL")
+# Ключ кэша префикса промпта (OpenAI-совместимый prompt_cache_key); по умолчанию не отправляется,
+# задавайте только если эндпоинт принимает это поле
+API_PROMPT_CACHE_KEY = os.getenv("API_PROMPT_CACHE_KEY", "")
 API_CACHE_SIZE = 50  # Уменьшили размер кэша для экономии памяти
-IMAGE_MAX_SIZE = (800, 800)  # Уменьшили размер для экономии трафика
+API_CACHE_TTL = 6 * 60 * 60  # 6 часов
+# Дисковый кэш ответов (нужен diskcache) переживает перезапуски бота; пустое значение отключает
+API_CACHE_DIR = os.getenv("API_CACHE_DIR", "api_cache")
+API_CACHE_DISK_SIZE_LIMIT = 512 * 1024 * 1024  # 512 МБ
+API_CACHE_DISK_TTL = 30 * 24 * 60 * 60  # 30 дней
+IMAGE_MAX_SIZE = (672, 672)  # Эффективное входное разрешение Qwen2.5-VL: больше модель не видит
 IMAGE_QUALITY = 75  # Немного снизили качество для экономии трафика
+IMAGE_SUBSAMPLING = 2  # Хроматическая субдискретизация 4:2:0
+# Потоки для декодирования голосовых сообщений в FLAC (сам запрос к Google асинхронный)
+STT_WORKERS = 8
+# Google Cloud Speech-to-Text v1; без GOOGLE_SPEECH_API_KEY голосовые сообщения отключены
+SPEECH_API_URL = "https://speech.googleapis.com/v1/speech:recognize"
+SPEECH_API_KEY = os.getenv("GOOGLE_SPEECH_API_KEY", "")
+SPEECH_LANGUAGE = "ru-RU"
+SPEECH_TIMEOUT = 30  # секунд
+# Частота дискретизации при перекодировании голосовых сообщений через ffmpeg
+VOICE_SAMPLE_RATE = 16000
+# Негативный кэш распознавания: неразборчивое аудио и сбои сервиса не повторяются сразу
+VOICE_FAILURE_CACHE_SIZE = 1024
+VOICE_UNRECOGNIZED_TTL = 60  # секунд
+VOICE_REQUEST_ERROR_TTL = 5  # секунд
+# Процессы для декодирования/масштабирования JPEG (ограничиваем, чтобы не раздувать память)
+IMAGE_WORKERS = min(4, os.cpu_count() or 1)
+
+# Семантический кэш для текстовых описаний (нужны sentence-transformers и faiss-cpu)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_TTL = 24 * 60 * 60  # 24 часа
+SEMANTIC_CACHE_MAX_SIZE = 10000
+
+# Пакетная запись истории калорий: вставки, пришедшие почти одновременно,
+# фиксируются одной транзакцией (один fsync на пакет)
+DB_WRITE_BATCH_WINDOW = 0.05  # секунд
+DB_WRITE_BATCH_MAX_SIZE = 64
 
 # Настройки валидации
 VALIDATION_LIMITS = {
@@ -5,20 +5,56 @@ import os
 import logging
 import threading
 import sqlite3
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Set, Tuple
 from contextlib import contextmanager
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
+from cachetools import TTLCache
 
 logger = logging.getLogger(__name__)
 
+# Кэш профилей: get_user вызывается несколько раз на каждое сообщение
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60  # секунд
+# Сумма калорий за сегодня: считается запросом один раз, дальше поддерживается при вставках
+DAILY_SUM_CACHE_TTL = 24 * 60 * 60  # секунд
+
+# Вставка записи о калориях: один и тот же текст запроса на каждый вызов,
+# поэтому SQLite берет уже подготовленное выражение из кэша соединения
+INSERT_CALORIE_RECORD_SQL_POSTGRES = (
+    "INSERT INTO calorie_history (user_id, food_name, calories, source) VALUES (%s, %s, %s, %s)"
+)
+INSERT_CALORIE_RECORD_SQL_SQLITE = (
+    "INSERT INTO calorie_history (user_id, food_name, calories, source) VALUES (?, ?, ?, ?)"
+)
+
+# Настройки SQLite, применяемые один раз при открытии постоянного соединения
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",  # около 20 МБ страничного кэша
+    "PRAGMA wal_autocheckpoint=1000",
+)
+
 class UserDatabase:
-    """Оптимизированный класс для работы с базой данных"""
+    """Оптимизированный класс для работы с базой данных
+    
+    Конструктор не обращается к базе: таблицы создает init_database() при запуске.
+    """
     
     def __init__(self, db_path: str = "users.db"):
         self.db_path = db_path
         self.use_postgres = os.getenv('DATABASE_URL') is not None
-        self._lock = threading.Lock()
-        self.init_database()
+        # RLock: init_database вызывает clean_corrupted_data, которая снова берет соединение
+        self._lock = threading.RLock()
+        # Постоянное соединение SQLite: его кэш подготовленных выражений
+        # переживает вызовы, и SQL не разбирается заново на каждом запросе
+        self._sqlite_conn: Optional[sqlite3.Connection] = None
+        self._user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+        self._user_cache_lock = threading.Lock()
+        # user_id -> (дата, сумма калорий); изменяется только под self._lock
+        self._daily_sums = TTLCache(maxsize=USER_CACHE_SIZE, ttl=DAILY_SUM_CACHE_TTL)
     
     @contextmanager
     def get_connection(self):
@@ -36,7 +72,9 @@ class UserDatabase:
                         password=url.password,
                         host=url.hostname,
                         port=url.port,
-                        connect_timeout=10
+                        connect_timeout=10,
+                        # CURRENT_TIMESTAMP и DATE(created_at) в UTC, как в SQLite
+                        options="-c timezone=UTC"
                     )
                     try:
                         yield conn
@@ -47,25 +85,44 @@ class UserDatabase:
                         conn.close()
                 except ImportError:
                     logger.warning("psycopg2 not available, falling back to SQLite")
-                    conn = sqlite3.connect(self.db_path, timeout=30.0)
-                    conn.row_factory = sqlite3.Row
+                    conn = self._get_sqlite_connection()
                     try:
                         yield conn
                     except Exception as e:
                         conn.rollback()
                         raise e
-                    finally:
-                        conn.close()
             else:
-                conn = sqlite3.connect(self.db_path, timeout=30.0)
-                conn.row_factory = sqlite3.Row
+                conn = self._get_sqlite_connection()
                 try:
                     yield conn
                 except Exception as e:
                     conn.rollback()
                     raise e
-                finally:
-                    conn.close()
+    
+    @staticmethod
+    def today() -> date:
+        """Текущая дата по UTC: created_at заполняется CURRENT_TIMESTAMP, а он в UTC"""
+        return datetime.now(timezone.utc).date()
+    
+    def _get_sqlite_connection(self) -> sqlite3.Connection:
+        """Общее соединение SQLite (вызывается под self._lock)"""
+        if self._sqlite_conn is None:
+            # Доступ сериализуется блокировкой, поэтому соединение можно отдавать разным потокам
+            conn = sqlite3.connect(self.db_path, timeout=30.0, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            # WAL: commit дописывает журнал вместо перезаписи страниц, читатели не ждут писателя;
+            # synchronous=NORMAL в режиме WAL делает fsync только при checkpoint
+            for pragma in SQLITE_PRAGMAS:
+                conn.execute(pragma)
+            self._sqlite_conn = conn
+        return self._sqlite_conn
+    
+    def close(self) -> None:
+        """Закрытие постоянного соединения SQLite"""
+        with self._lock:
+            if self._sqlite_conn is not None:
+                self._sqlite_conn.close()
+                self._sqlite_conn = None
     
     def init_database(self):
         """Инициализация базы данных с оптимизированной структурой"""
@@ -167,7 +224,7 @@ class UserDatabase:
                 logger.info("Database initialized successfully")
                 
         except Exception as e:
-            logger.error(f"Error initializing database: {e}")
+            logger.error("Error initializing database: %s", e)
     
     def add_user(self, user_data: Dict[str, Any]) -> bool:
         """Добавление или обновление пользователя"""
@@ -207,15 +264,34 @@ class UserDatabase:
                     ))
                 
                 conn.commit()
-                logger.info(f"User {user_data['user_id']} added/updated successfully")
+                self.invalidate_user(user_data['user_id'])
+                logger.info("User %s added/updated successfully", user_data['user_id'])
                 return True
                 
         except Exception as e:
-            logger.error(f"Error adding user: {e}")
+            logger.error("Error adding user: %s", e)
             return False
     
+    def invalidate_user(self, user_id: int) -> None:
+        """Удаление профиля из кэша после изменения"""
+        with self._user_cache_lock:
+            self._user_cache.pop(user_id, None)
+    
     def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        """Получение пользователя по ID"""
+        """Получение пользователя по ID (с кэшированием на USER_CACHE_TTL секунд)"""
+        with self._user_cache_lock:
+            user = self._user_cache.get(user_id)
+        if user is not None:
+            return user
+        
+        user = self._fetch_user(user_id)
+        if user is not None:
+            with self._user_cache_lock:
+                self._user_cache[user_id] = user
+        return user
+    
+    def _fetch_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Чтение пользователя из базы данных"""
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
@@ -235,46 +311,70 @@ class UserDatabase:
                 return None
                 
         except Exception as e:
-            logger.error(f"Error getting user: {e}")
+            logger.error("Error getting user: %s", e)
             return None
     
+    @staticmethod
+    def _prepare_calorie_record(user_id: int, food_name: str, calories: int, source: str) -> Tuple[int, str, int, str]:
+        """Приведение записи о калориях к сохраняемому виду"""
+        # Упрощаем данные для оптимизации
+        max_food_name_length = 50
+        if len(food_name) > max_food_name_length:
+            food_name = food_name[:max_food_name_length-3] + "..."
+        
+        # Маппинг источников для краткости
+        source_map = {
+            "photo": "фото",
+            "text": "текст", 
+            "voice": "голос",
+            "unknown": "другое"
+        }
+        return user_id, food_name, calories, source_map.get(source, "другое")
+    
     def add_calorie_record(self, user_id: int, food_name: str, calories: int, source: str = "unknown") -> bool:
         """Добавление записи о калориях"""
+        if self.add_calorie_records([(user_id, food_name, calories, source)]):
+            logger.info("Successfully added calorie record for user %s", user_id)
+            return True
+        return False
+    
+    def add_calorie_records(self, records: List[Tuple[int, str, int, str]]) -> bool:
+        """Добавление нескольких записей о калориях одной транзакцией (один commit на пакет)"""
         try:
-            # Упрощаем данные для оптимизации
-            max_food_name_length = 50
-            if len(food_name) > max_food_name_length:
-                food_name = food_name[:max_food_name_length-3] + "..."
-            
-            # Маппинг источников для краткости
-            source_map = {
-                "photo": "фото",
-                "text": "текст", 
-                "voice": "голос",
-                "unknown": "другое"
-            }
-            source = source_map.get(source, "другое")
+            rows = [self._prepare_calorie_record(*record) for record in records]
             
             with self.get_connection() as conn:
                 cursor = conn.cursor()
                 
-                if self.use_postgres:
-                    cursor.execute('''
-                        INSERT INTO calorie_history (user_id, food_name, calories, source)
-                        VALUES (%s, %s, %s, %s)
-                    ''', (user_id, food_name, calories, source))
-                else:
-                    cursor.execute('''
-                        INSERT INTO calorie_history (user_id, food_name, calories, source)
-                        VALUES (?, ?, ?, ?)
-                    ''', (user_id, food_name, calories, source))
+                cursor.executemany(
+                    INSERT_CALORIE_RECORD_SQL_POSTGRES if self.use_postgres else INSERT_CALORIE_RECORD_SQL_SQLITE,
+                    rows
+                )
+                
+                # Суммы за сегодня, которых нет в кэше, считаем в той же транзакции:
+                # ответ с дневной суммой после записи не требует отдельного запроса
+                today = self.today()
+                uncached = {
+                    user_id for user_id, _, _, _ in rows
+                    if self._daily_sums.get(user_id, (None,))[0] != today
+                }
+                fresh_sums = self._select_daily_sums(cursor, uncached, today) if uncached else {}
                 
                 conn.commit()
-                logger.info(f"Successfully added calorie record for user {user_id}")
+                
+                # Досчитываем закэшированные суммы за сегодня вместо повторной агрегации
+                for user_id, _, calories, _ in rows:
+                    if user_id in uncached:
+                        continue
+                    cached = self._daily_sums.get(user_id)
+                    if cached is not None and cached[0] == today:
+                        self._daily_sums[user_id] = (today, cached[1] + calories)
+                for user_id, daily_sum in fresh_sums.items():
+                    self._daily_sums[user_id] = (today, daily_sum)
                 return True
                 
         except Exception as e:
-            logger.error(f"Error adding calorie record: {e}")
+            logger.error("Error adding calorie records: %s", e)
             return False
     
     def get_user_calorie_history(self, user_id: int, limit: int = 50) -> List[Dict[str, Any]]:
@@ -312,7 +412,7 @@ class UserDatabase:
                 return history
                 
         except Exception as e:
-            logger.error(f"Error getting calorie history: {e}")
+            logger.error("Error getting calorie history: %s", e)
             return []
     
     def get_user_calorie_history_by_period(self, user_id: int, start_date: date, end_date: date) -> List[Dict[str, Any]]:
@@ -352,7 +452,7 @@ class UserDatabase:
                 return history
                 
         except Exception as e:
-            logger.error(f"Error getting calorie history by period: {e}")
+            logger.error("Error getting calorie history by period: %s", e)
             return []
     
     def get_weekly_calories_summary(self, user_id: int) -> Dict[str, Any]:
@@ -410,11 +510,85 @@ class UserDatabase:
                 }
                 
         except Exception as e:
-            logger.error(f"Error getting weekly calories summary: {e}")
+            logger.error("Error getting weekly calories summary: %s", e)
             return {'daily_data': {}, 'total_weekly': 0, 'days_count': 0}
     
-    def get_daily_calories_sum(self, user_id: int) -> int:
-        """Получение суммы калорий за сегодня"""
+    def get_daily_calorie_totals(self, user_id: int, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+        """Суммы калорий по дням за период (агрегация выполняется в базе данных)"""
+        try:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                
+                if self.use_postgres:
+                    cursor.execute('''
+                        SELECT 
+                            DATE(created_at) as date,
+                            CAST(EXTRACT(DOW FROM DATE(created_at)) AS INTEGER) as weekday,
+                            SUM(calories) as daily_total,
+                            COUNT(*) as meals_count
+                        FROM calorie_history 
+                        WHERE user_id = %s 
+                        AND DATE(created_at) >= %s 
+                        AND DATE(created_at) <= %s
+                        GROUP BY DATE(created_at)
+                        ORDER BY date DESC
+                    ''', (user_id, start_date, end_date))
+                else:
+                    cursor.execute('''
+                        SELECT 
+                            DATE(created_at) as date,
+                            CAST(strftime('%w', created_at) AS INTEGER) as weekday,
+                            SUM(calories) as daily_total,
+                            COUNT(*) as meals_count
+                        FROM calorie_history 
+                        WHERE user_id = ? 
+                        AND DATE(created_at) >= ? 
+                        AND DATE(created_at) <= ?
+                        GROUP BY DATE(created_at)
+                        ORDER BY date DESC
+                    ''', (user_id, start_date, end_date))
+                
+                return [
+                    {
+                        'date': str(row[0]),
+                        'weekday': row[1],
+                        'calories': row[2] or 0,
+                        'meals': row[3] or 0
+                    }
+                    for row in cursor.fetchall()
+                ]
+                
+        except Exception as e:
+            logger.error("Error getting daily calorie totals: %s", e)
+            return []
+    
+    def _select_daily_sums(self, cursor, user_ids: Set[int], day: date) -> Dict[int, int]:
+        """Суммы калорий за день для нескольких пользователей одним запросом"""
+        if self.use_postgres:
+            cursor.execute('''
+                SELECT user_id, COALESCE(SUM(calories), 0) FROM calorie_history 
+                WHERE user_id = ANY(%s) AND DATE(created_at) = %s
+                GROUP BY user_id
+            ''', (list(user_ids), day))
+        else:
+            placeholders = ", ".join("?" * len(user_ids))
+            cursor.execute(f'''
+                SELECT user_id, COALESCE(SUM(calories), 0) FROM calorie_history 
+                WHERE user_id IN ({placeholders}) AND DATE(created_at) = ?
+                GROUP BY user_id
+            ''', (*user_ids, day.isoformat()))
+        return dict(cursor.fetchall())
+    
+    def get_daily_calories_sum(self, user_id: int, day: Optional[date] = None) -> int:
+        """Получение суммы калорий за день (по умолчанию за сегодня)"""
+        # Дата передается параметром: тот же "сегодня", что и в истории за период,
+        # а условие DATE(created_at) = ? идет по индексу idx_calorie_history_user_date
+        today = self.today()
+        day = day or today
+        with self._lock:
+            cached = self._daily_sums.get(user_id)
+            if cached is not None and cached[0] == day:
+                return cached[1]
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
@@ -422,25 +596,28 @@ class UserDatabase:
                 if self.use_postgres:
                     cursor.execute('''
                         SELECT COALESCE(SUM(calories), 0) FROM calorie_history 
-                        WHERE user_id = %s AND DATE(created_at) = CURRENT_DATE
-                    ''', (user_id,))
+                        WHERE user_id = %s AND DATE(created_at) = %s
+                    ''', (user_id, day))
                 else:
                     cursor.execute('''
                         SELECT COALESCE(SUM(calories), 0) FROM calorie_history 
-                        WHERE user_id = ? AND DATE(created_at) = DATE('now')
-                    ''', (user_id,))
+                        WHERE user_id = ? AND DATE(created_at) = ?
+                    ''', (user_id, day.isoformat()))
                 
                 result = cursor.fetchone()
                 daily_sum = result[0] if result else 0
-                logger.info(f"Daily calories sum for user {user_id}: {daily_sum}")
+                if day == today:
+                    self._daily_sums[user_id] = (day, daily_sum)
+                logger.info("Daily calories sum for user %s: %s", user_id, daily_sum)
                 return daily_sum
                 
         except Exception as e:
-            logger.error(f"Error getting daily calories sum: {e}")
+            logger.error("Error getting daily calories sum: %s", e)
             return 0
     
     def reset_daily_calories(self, user_id: int) -> bool:
         """Сброс калорий за сегодняшний день"""
+        today = self.today()
         try:
             with self.get_connection() as conn:
                 cursor = conn.cursor()
@@ -448,20 +625,21 @@ class UserDatabase:
                 if self.use_postgres:
                     cursor.execute('''
                         DELETE FROM calorie_history 
-                        WHERE user_id = %s AND DATE(created_at) = CURRENT_DATE
-                    ''', (user_id,))
+                        WHERE user_id = %s AND DATE(created_at) = %s
+                    ''', (user_id, today))
                 else:
                     cursor.execute('''
                         DELETE FROM calorie_history 
-                        WHERE user_id = ? AND DATE(created_at) = DATE('now')
-                    ''', (user_id,))
+                        WHERE user_id = ? AND DATE(created_at) = ?
+                    ''', (user_id, today.isoformat()))
                 
                 conn.commit()
-                logger.info(f"Daily calories reset for user {user_id}")
+                self._daily_sums.pop(user_id, None)
+                logger.info("Daily calories reset for user %s", user_id)
                 return True
                 
         except Exception as e:
-            logger.error(f"Error resetting daily calories: {e}")
+            logger.error("Error resetting daily calories: %s", e)
             return False
     
     def reset_user_data(self, user_id: int) -> bool:
@@ -479,11 +657,13 @@ class UserDatabase:
                     cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
                 
                 conn.commit()
-                logger.info(f"User {user_id} data reset successfully")
+                self.invalidate_user(user_id)
+                self._daily_sums.pop(user_id, None)
+                logger.info("User %s data reset successfully", user_id)
                 return True
                 
         except Exception as e:
-            logger.error(f"Error resetting user data: {e}")
+            logger.error("Error resetting user data: %s", e)
             return False
     
     def clean_corrupted_data(self) -> bool:
@@ -509,12 +689,12 @@ class UserDatabase:
                 conn.commit()
                 
                 if deleted_count > 0:
-                    logger.info(f"Cleaned {deleted_count} corrupted calorie records")
+                    logger.info("Cleaned %s corrupted calorie records", deleted_count)
                 
                 return True
                 
         except Exception as e:
-            logger.error(f"Error cleaning corrupted data: {e}")
+            logger.error("Error cleaning corrupted data: %s", e)
             return False
     
     def calculate_daily_calories(self, gender: str, age: int, height: float, weight: float, 
@@ -536,20 +716,20 @@ class UserDatabase:
                 'физическая работа': 1.9
             }
             
-            logger.info(f"Calculate daily calories - activity_level: {repr(activity_level)}")
-            logger.info(f"Calculate daily calories - activity_level.lower(): {repr(activity_level.lower())}")
-            logger.info(f"Calculate daily calories - activity_multipliers: {activity_multipliers}")
+            logger.debug("Calculate daily calories - activity_level: %r", activity_level)
+            logger.debug("Calculate daily calories - activity_level.lower(): %r", activity_level.lower())
+            logger.debug("Calculate daily calories - activity_multipliers: %s", activity_multipliers)
             
             multiplier = activity_multipliers.get(activity_level.lower(), 1.2)
             
-            logger.info(f"Calculate daily calories - selected multiplier: {multiplier}")
-            logger.info(f"Calculate daily calories - BMR: {bmr:.2f}")
+            logger.debug("Calculate daily calories - selected multiplier: %s", multiplier)
+            logger.debug("Calculate daily calories - BMR: %.2f", bmr)
             
             daily_calories = int(bmr * multiplier)
             
-            logger.info(f"Calculate daily calories - final result: {daily_calories} for {gender}, age {age}, height {height}, weight {weight}, activity {activity_level}")
+            logger.debug("Calculate daily calories - final result: %s for %s, age %s, height %s, weight %s, activity %s", daily_calories, gender, age, height, weight, activity_level)
             return daily_calories
             
         except Exception as e:
-            logger.error(f"Error calculating daily calories: {e}")
+            logger.error("Error calculating daily calories: %s", e)
             return 2000  # Значение по умолчанию
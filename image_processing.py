@@ -0,0 +1,68 @@
+"""
+Подготовка изображений для API (выполняется в отдельных процессах)
+"""
+import base64
+import io
+import logging
+from PIL import Image
+from config import IMAGE_MAX_SIZE, IMAGE_QUALITY, IMAGE_SUBSAMPLING
+
+logger = logging.getLogger(__name__)
+
+# Pillow регистрирует кодеки лениво; регистрируем их при импорте (в т.ч. в каждом
+# процессе пула), чтобы первое фото не платило за инициализацию
+Image.init()
+
+# Опциональная lossless-оптимизация JPEG через mozjpeg (trellis, оптимальные таблицы Хаффмана)
+try:
+    import mozjpeg_lossless_optimization
+except ImportError:
+    mozjpeg_lossless_optimization = None
+
+# Префикс data URL для JPEG в виде bytes: base64 приклеивается без промежуточных строк
+DATA_URL_PREFIX = b"data:image/jpeg;base64,"
+
+def _build_data_url(jpeg_data) -> bytes:
+    """data URL из JPEG (bytes или memoryview) без промежуточных str"""
+    return b"".join((DATA_URL_PREFIX, base64.b64encode(jpeg_data)))
+
+def warm_up() -> None:
+    """Пустая задача для запуска процессов пула (кодеки уже загружены при импорте)"""
+
+def prepare_image(image_data: bytes) -> bytes:
+    """Подготовка изображения для API в виде data URL (ASCII bytes)
+
+    Функция модульного уровня, чтобы ее можно было передать в ProcessPoolExecutor.
+    """
+    try:
+        # Открываем изображение (читается только заголовок, без декодирования)
+        image = Image.open(io.BytesIO(image_data))
+
+        # JPEG, который уже укладывается в лимит, отправляем без перекодирования
+        if (image.format == "JPEG" and image.width <= IMAGE_MAX_SIZE[0]
+                and image.height <= IMAGE_MAX_SIZE[1]):
+            return _build_data_url(image_data)
+
+        # libjpeg уменьшает JPEG в 2/4/8 раз прямо при декодировании;
+        # оставляем двукратный запас для качественного финального шага
+        if image.format == "JPEG":
+            image.draft("RGB", (IMAGE_MAX_SIZE[0] * 2, IMAGE_MAX_SIZE[1] * 2))
+
+        # Оптимизируем размер изображения для API
+        # BICUBIC заметно дешевле LANCZOS, разница для модели незаметна
+        image.thumbnail(IMAGE_MAX_SIZE, Image.Resampling.BICUBIC)
+
+        # Кодируем с оптимизированными таблицами Хаффмана: меньше байт в запросе
+        buffered = io.BytesIO()
+        image.save(
+            buffered, format="JPEG", quality=IMAGE_QUALITY,
+            subsampling=IMAGE_SUBSAMPLING, optimize=True
+        )
+        if mozjpeg_lossless_optimization is not None:
+            return _build_data_url(mozjpeg_lossless_optimization.optimize(buffered.getvalue()))
+
+        # getbuffer() отдает закодированный JPEG без копирования в новый bytes
+        return _build_data_url(buffered.getbuffer())
+    except Exception as e:
+        logger.error("Error preparing image: %s", e)
+        raise
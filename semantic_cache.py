@@ -0,0 +1,140 @@
+"""
+Семантический кэш ответов API для текстовых описаний еды
+"""
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Числа в описании (граммы, штуки, проценты): похожие по смыслу описания с разными
+# количествами ("гречка 200 г" и "гречка 400 г") не считаются совпадением
+NUMBER_PATTERN = re.compile(r'\d+(?:[.,]\d+)?')
+# Сколько ближайших описаний проверяется на совпадение чисел
+SEARCH_CANDIDATES = 5
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+def _extract_numbers(normalized: str) -> Tuple[str, ...]:
+    return tuple(number.replace(',', '.') for number in NUMBER_PATTERN.findall(normalized))
+
+class SemanticCache:
+    """Кэш по смысловой близости описаний (sentence embeddings + FAISS)
+    
+    Модель загружается методом load() в фоне после запуска бота; до этого
+    get() ничего не находит, а put() ничего не сохраняет.
+    """
+    
+    def __init__(self, model_name: str, similarity_threshold: float = 0.92,
+                 ttl: int = 24 * 60 * 60, max_size: int = 10000):
+        self.model_name = model_name
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        
+        self._np = None
+        self._model = None
+        self._index = None
+        
+        # id -> (ответ, числа описания, время истечения); порядок = LRU
+        self._entries: "OrderedDict[int, Tuple[str, Tuple[str, ...], float]]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def ready(self) -> bool:
+        return self._index is not None
+    
+    def load(self) -> bool:
+        """Загрузка модели и индекса (блокирующая: вызывается в пуле потоков)"""
+        try:
+            # Тяжелые зависимости импортируются только при включенном кэше
+            import faiss
+            import numpy as np
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            logger.warning("sentence-transformers or faiss not available, semantic cache disabled")
+            return False
+        
+        try:
+            model = SentenceTransformer(self.model_name)
+            dimension = model.get_sentence_embedding_dimension()
+            # Нормализованные векторы: скалярное произведение = косинусная близость
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        except Exception as e:
+            logger.error("Error initializing semantic cache: %s", e)
+            return False
+        
+        self._np = np
+        self._model = model
+        self._index = index
+        logger.info("Semantic cache enabled with model %s", self.model_name)
+        return True
+    
+    def _embed(self, normalized: str):
+        """Эмбеддинг нормализованного описания"""
+        vector = self._model.encode([normalized], normalize_embeddings=True)
+        return self._np.asarray(vector, dtype="float32")
+    
+    def _remove(self, entry_id: int) -> None:
+        self._entries.pop(entry_id, None)
+        self._index.remove_ids(self._np.array([entry_id], dtype="int64"))
+    
+    def get(self, text: str) -> Optional[str]:
+        """Поиск ответа для похожего описания с теми же числами"""
+        if not self.ready:
+            return None
+        normalized = _normalize(text)
+        numbers = _extract_numbers(normalized)
+        vector = self._embed(normalized)
+        with self._lock:
+            if not self._entries:
+                return None
+            
+            scores, ids = self._index.search(vector, SEARCH_CANDIDATES)
+            now = time.monotonic()
+            for entry_id, score in zip(ids[0].tolist(), scores[0].tolist()):
+                if entry_id < 0 or score < self.similarity_threshold:
+                    break
+                
+                entry = self._entries.get(entry_id)
+                if entry is None:
+                    continue
+                result, entry_numbers, expires_at = entry
+                if expires_at < now:
+                    self._remove(entry_id)
+                    continue
+                # Близость эмбеддингов не различает порции: числа должны совпадать точно
+                if entry_numbers != numbers:
+                    continue
+                
+                self._entries.move_to_end(entry_id)
+                logger.info("Semantic cache hit (similarity %.3f)", score)
+                return result
+            return None
+    
+    def put(self, text: str, result: str) -> None:
+        """Сохранение ответа для описания"""
+        if not self.ready:
+            return
+        normalized = _normalize(text)
+        vector = self._embed(normalized)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(vector, self._np.array([entry_id], dtype="int64"))
+            self._entries[entry_id] = (result, _extract_numbers(normalized), time.monotonic() + self.ttl)
+            
+            # Вытесняем самые давно использованные записи
+            while len(self._entries) > self.max_size:
+                oldest_id = next(iter(self._entries))
+                self._remove(oldest_id)
+
+def create_semantic_cache(model_name: str, similarity_threshold: float,
+                          ttl: int, max_size: int) -> Optional[SemanticCache]:
+    """Создание кэша без загрузки модели (модель загружает SemanticCache.load)"""
+    return SemanticCache(model_name, similarity_threshold, ttl, max_size)
@@ -0,0 +1,86 @@
+"""
+Асинхронный клиент Google Cloud Speech-to-Text (REST v1, speech:recognize)
+"""
+import asyncio
+import base64
+import logging
+from typing import Optional
+import aiohttp
+import orjson
+from config import SPEECH_API_URL, SPEECH_API_KEY, SPEECH_LANGUAGE, SPEECH_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+class SpeechNotRecognizedError(Exception):
+    """Сервис ответил, но речь в аудио не распознана"""
+
+class SpeechServiceError(Exception):
+    """Сервис распознавания недоступен или вернул ошибку"""
+
+class GoogleSpeechClient:
+    """Отправка FLAC в Google Speech-to-Text через общую сессию aiohttp"""
+    
+    def __init__(self, api_url: str, api_key: str, language: str):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.language = language
+        # Сессия создается лениво: aiohttp требует запущенный event loop
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Общая сессия: соединение с сервисом переиспользуется между сообщениями"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=SPEECH_TIMEOUT)
+            )
+        return self._session
+    
+    @property
+    def enabled(self) -> bool:
+        """Распознавание доступно только с настроенным ключом API"""
+        return bool(self.api_key)
+    
+    async def close(self) -> None:
+        """Закрытие сессии при остановке бота"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    @staticmethod
+    def _parse_transcript(body: bytes) -> str:
+        """Текст из ответа: без results речь не распознана, фрагменты склеиваются по порядку"""
+        results = orjson.loads(body).get("results")
+        transcripts = [
+            result["alternatives"][0]["transcript"]
+            for result in results or ()
+            if result.get("alternatives")
+        ]
+        text = " ".join(transcript.strip() for transcript in transcripts).strip()
+        if not text:
+            raise SpeechNotRecognizedError("No transcript in speech API response")
+        return text
+    
+    async def recognize(self, flac_data: bytes, sample_rate: int) -> str:
+        """Распознавание FLAC-аудио; ошибки - SpeechNotRecognizedError и SpeechServiceError"""
+        if not self.enabled:
+            raise SpeechServiceError("GOOGLE_SPEECH_API_KEY is not configured")
+        payload = orjson.dumps({
+            "config": {"encoding": "FLAC", "sampleRateHertz": sample_rate, "languageCode": self.language},
+            "audio": {"content": base64.b64encode(flac_data).decode("ascii")}
+        })
+        headers = {"Content-Type": "application/json", "X-Goog-Api-Key": self.api_key}
+        try:
+            async with self._get_session().post(self.api_url, data=payload, headers=headers) as response:
+                if response.status != 200:
+                    raise SpeechServiceError(f"Speech API returned status {response.status}")
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise SpeechServiceError(f"Speech API request failed: {e}") from e
+        
+        try:
+            return self._parse_transcript(body)
+        except (orjson.JSONDecodeError, KeyError, IndexError, TypeError, AttributeError) as e:
+            raise SpeechServiceError(f"Unexpected speech API response: {e}") from e
+
+# Глобальный экземпляр клиента
+speech_client = GoogleSpeechClient(SPEECH_API_URL, SPEECH_API_KEY, SPEECH_LANGUAGE)
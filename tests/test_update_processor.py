@@ -0,0 +1,72 @@
+"""
+Тесты PerChatUpdateProcessor: перегруженный чат не занимает общий лимит обновлений
+"""
+import asyncio
+import datetime
+import unittest
+from unittest.mock import AsyncMock
+from telegram import Chat, Message, Update
+from update_processor import PerChatUpdateProcessor, BUSY_CHAT_MESSAGE
+
+def make_update(update_id: int, chat_id: int, bot: AsyncMock) -> Update:
+    message = Message(
+        message_id=update_id,
+        date=datetime.datetime.now(datetime.timezone.utc),
+        chat=Chat(id=chat_id, type=Chat.PRIVATE)
+    )
+    message.set_bot(bot)
+    return Update(update_id=update_id, message=message)
+
+class PerChatUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_other_chat_processed_while_first_is_saturated(self):
+        processor = PerChatUpdateProcessor(max_concurrent_updates=4, max_pending_per_chat=2)
+        bot = AsyncMock()
+        release = asyncio.Event()
+        started = []
+        
+        async def slow_handler(update_id: int) -> None:
+            started.append(update_id)
+            await release.wait()
+        
+        # Первый чат присылает больше обновлений, чем общий лимит
+        flood = [
+            asyncio.create_task(processor.process_update(make_update(i, 1, bot), slow_handler(i)))
+            for i in range(1, 11)
+        ]
+        await asyncio.sleep(0.01)
+        
+        # Второй чат обрабатывается, пока первый ждет
+        handled = asyncio.Event()
+        
+        async def handler() -> None:
+            handled.set()
+        
+        await asyncio.wait_for(processor.process_update(make_update(100, 2, bot), handler()), timeout=1)
+        self.assertTrue(handled.is_set())
+        
+        # В первом чате одно обновление в работе, одно в очереди, остальные отклонены
+        # с одним предупреждением пользователю
+        self.assertEqual(started, [1])
+        bot.send_message.assert_awaited_once()
+        self.assertEqual(bot.send_message.await_args.kwargs["text"], BUSY_CHAT_MESSAGE)
+        
+        release.set()
+        await asyncio.wait_for(asyncio.gather(*flood), timeout=1)
+        self.assertEqual(started, [1, 2])
+    
+    async def test_chat_accepts_updates_again_after_queue_drains(self):
+        processor = PerChatUpdateProcessor(max_concurrent_updates=4, max_pending_per_chat=1)
+        bot = AsyncMock()
+        handled = []
+        
+        async def handler(update_id: int) -> None:
+            handled.append(update_id)
+        
+        for update_id in (1, 2):
+            await processor.process_update(make_update(update_id, 1, bot), handler(update_id))
+        self.assertEqual(handled, [1, 2])
+        bot.send_message.assert_not_awaited()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Обработка обновлений Telegram: по порядку внутри чата, параллельно между чатами
+"""
+import asyncio
+import inspect
+import logging
+import weakref
+from typing import Awaitable, Dict, Set
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+BUSY_CHAT_MESSAGE = "⏳ Обрабатываю предыдущие сообщения. Отправьте это еще раз, когда придет ответ."
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Обновления одного чата ждут друг друга (user_data регистрации меняется последовательно),
+    а медленный анализ в одном чате не задерживает ответы в других"""
+    
+    def __init__(self, max_concurrent_updates: int, max_pending_per_chat: int):
+        super().__init__(max_concurrent_updates)
+        self.max_pending_per_chat = max_pending_per_chat
+        # Блокировка живет, пока ее держат или ждут обработчики чата, затем удаляется сама
+        self._chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+        # Обновления чата в работе и в очереди: каждое из них занимает место
+        # в общем лимите, поэтому один чат не может забрать его целиком
+        self._pending: Dict[int, int] = {}
+        # Чаты, которым уже отправлено предупреждение о перегрузке
+        self._notified: Set[int] = set()
+    
+    async def _reject(self, update: Update, coroutine: Awaitable) -> None:
+        """Лишнее обновление не обрабатывается; пользователь узнает об этом один раз"""
+        chat_id = update.effective_chat.id
+        if inspect.iscoroutine(coroutine):
+            coroutine.close()
+        logger.warning("Chat %s has %d pending updates, update %s dropped",
+                       chat_id, self._pending[chat_id], update.update_id)
+        if chat_id in self._notified or update.effective_message is None:
+            return
+        self._notified.add(chat_id)
+        try:
+            await update.effective_message.reply_text(BUSY_CHAT_MESSAGE)
+        except TelegramError as e:
+            logger.warning("Failed to notify chat %s about dropped update: %s", chat_id, e)
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+        
+        if self._pending.get(chat.id, 0) >= self.max_pending_per_chat:
+            await self._reject(update, coroutine)
+            return
+        
+        self._pending[chat.id] = self._pending.get(chat.id, 0) + 1
+        try:
+            lock = self._chat_locks.get(chat.id)
+            if lock is None:
+                lock = self._chat_locks[chat.id] = asyncio.Lock()
+            async with lock:
+                await coroutine
+        finally:
+            self._pending[chat.id] -= 1
+            if not self._pending[chat.id]:
+                del self._pending[chat.id]
+                self._notified.discard(chat.id)
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
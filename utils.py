@@ -4,8 +4,16 @@
 import re
 import hashlib
 import logging
+import unicodedata
+from datetime import datetime
+from functools import lru_cache
 from typing import Optional, Any
 from telegram import Update
+# xxHash (XXH3) хэширует на скорости памяти; без него ключи кэша считает blake2b
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 logger = logging.getLogger(__name__)
 
@@ -35,28 +43,38 @@ def validate_user_input(text: str, input_type: str) -> Optional[Any]:
     except (ValueError, TypeError):
         return None
 
+# Первое число в ответе модели (компилируется один раз при импорте)
+CALORIES_PATTERN = re.compile(r'\d+')
+
 def extract_calories_from_text(text: str) -> Optional[int]:
     """Извлечение количества калорий из текста"""
     try:
-        # Ищем числа в тексте
-        numbers = re.findall(r'\d+', text)
-        if numbers:
-            # Возвращаем первое найденное число
-            return int(numbers[0])
+        # Ищем первое число, не собирая остальные
+        match = CALORIES_PATTERN.search(text)
+        if match:
+            return int(match.group())
         return None
     except (ValueError, TypeError):
         return None
 
+# Шаблоны ответа с калориями (собираются одним вызовом format)
+CALORIE_RESPONSE_TEMPLATE = (
+    "Примерное количество калорий: {calories}\n\n"
+    "Общее количество калорий за сегодня: {daily_sum}"
+)
+CALORIE_RESPONSE_WITH_NORM_TEMPLATE = (
+    CALORIE_RESPONSE_TEMPLATE +
+    "\n\n📊 Это составляет {percentage:.1f}% от вашей суточной нормы ({daily_calories} ккал)"
+)
+
 def format_calorie_response(calories: int, daily_sum: int, daily_calories: int) -> str:
     """Форматирование ответа с калориями"""
     if daily_calories > 0:
-        percentage = (daily_sum / daily_calories) * 100
-        return (f"Примерное количество калорий: {calories}\n\n"
-                f"Общее количество калорий за сегодня: {daily_sum}\n\n"
-                f"📊 Это составляет {percentage:.1f}% от вашей суточной нормы ({daily_calories} ккал)")
-    else:
-        return (f"Примерное количество калорий: {calories}\n\n"
-                f"Общее количество калорий за сегодня: {daily_sum}")
+        return CALORIE_RESPONSE_WITH_NORM_TEMPLATE.format(
+            calories=calories, daily_sum=daily_sum, daily_calories=daily_calories,
+            percentage=daily_sum / daily_calories * 100
+        )
+    return CALORIE_RESPONSE_TEMPLATE.format(calories=calories, daily_sum=daily_sum)
 
 async def safe_reply(update: Update, text: str, **kwargs) -> bool:
     """Безопасная отправка сообщения с обработкой ошибок"""
@@ -67,34 +85,96 @@ async def safe_reply(update: Update, text: str, **kwargs) -> bool:
             await update.callback_query.edit_message_text(text, **kwargs)
         return True
     except Exception as e:
-        logger.error(f"Error sending message: {e}")
+        logger.error("Error sending message: %s", e)
         return False
 
+def _hash_bytes(data: Any) -> str:
+    """128-битный некриптографический ключ кэша (bytes, bytearray или memoryview)"""
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
 def create_image_hash(image_data: bytes) -> str:
-    """Создание хэша изображения для кэширования"""
-    return hashlib.md5(image_data).hexdigest()
+    """Создание хэша изображения для кэширования (bytes или bytearray без копирования)"""
+    # memoryview передает буфер в хэш-функцию напрямую, без bytes(image_data)
+    return _hash_bytes(memoryview(image_data))
+
+def normalize_text(text: str) -> str:
+    """Нормализация описания: регистр, юникод-формы, пробелы и пунктуация по краям"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(text.split()).strip(" .,!?;:")
 
 def create_text_hash(text: str) -> str:
-    """Создание хэша текста для кэширования"""
-    return hashlib.md5(text.lower().encode()).hexdigest()
+    """Создание хэша нормализованного текста для кэширования"""
+    return _hash_bytes(normalize_text(text).encode("utf-8"))
+
+# Одинаковые метки времени (пакетные вставки, повторный просмотр истории) разбираются один раз
+@lru_cache(maxsize=4096)
+def format_record_time(created_at: Any) -> str:
+    """Время записи истории в формате ЧЧ:ММ (datetime из PostgreSQL или строка из SQLite)"""
+    if isinstance(created_at, datetime):
+        return created_at.strftime("%H:%M")
+    if not isinstance(created_at, str):
+        return "неизвестно"
+    
+    # fromisoformat (C-реализация) разбирает и ISO, и SQLite-формат "ГГГГ-ММ-ДД ЧЧ:ММ:СС"
+    if created_at.endswith('Z'):
+        created_at = created_at[:-1] + '+00:00'
+    try:
+        return datetime.fromisoformat(created_at).strftime("%H:%M")
+    except ValueError:
+        # Если не удается распарсить дату, показываем как есть
+        logger.warning("Error parsing time for record: %s", created_at)
+        if ' ' in created_at:
+            return created_at.split(' ')[-1][:5]
+        return "неизвестно"
+
+# Таблицы отображения создаются один раз при импорте
+ACTIVITY_DISPLAY = {
+    'сидячая работа': '🏢 Сидячая работа (офис, учеба)',
+    'легкая активность': '🚶 Легкая активность (прогулки, домашние дела)',
+    'умеренная активность': '🏃 Умеренная активность (спорт 3-5 раз/неделю)',
+    'высокая активность': '💪 Высокая активность (спорт 6-7 раз/неделю)',
+    'физическая работа': '🏗️ Физическая работа (строительство, грузчик)'
+}
+MEAL_DISPLAY = {
+    'breakfast': '🌅 Завтрак',
+    'lunch': '🍽️ Обед',
+    'dinner': '🌙 Ужин',
+    'snack': '🍎 Перекус'
+}
 
 def format_activity_display(activity_level: str) -> str:
     """Форматирование отображения уровня активности"""
-    activity_display = {
-        'сидячая работа': '🏢 Сидячая работа (офис, учеба)',
-        'легкая активность': '🚶 Легкая активность (прогулки, домашние дела)',
-        'умеренная активность': '🏃 Умеренная активность (спорт 3-5 раз/неделю)',
-        'высокая активность': '💪 Высокая активность (спорт 6-7 раз/неделю)',
-        'физическая работа': '🏗️ Физическая работа (строительство, грузчик)'
-    }
-    return activity_display.get(activity_level, activity_level)
+    return ACTIVITY_DISPLAY.get(activity_level, activity_level)
 
 def format_meal_display(meal_key: str) -> str:
     """Форматирование отображения типа приема пищи"""
-    meal_display = {
-        'breakfast': '🌅 Завтрак',
-        'lunch': '🍽️ Обед',
-        'dinner': '🌙 Ужин',
-        'snack': '🍎 Перекус'
-    }
-    return meal_display.get(meal_key, '🍽️ Блюдо')
+    return MEAL_DISPLAY.get(meal_key, '🍽️ Блюдо')
+
+@lru_cache(maxsize=2048)
+def format_profile(name: Any, gender: Any, age: Any, height: Any, weight: Any,
+                   activity_level: Any, daily_calories: Any) -> str:
+    """Текст профиля пользователя (зависит только от полей профиля, поэтому кэшируется)"""
+    lines = [
+        "👤 Ваш профиль:",
+        "",
+        f"Имя: {name}",
+        f"Пол: {gender}",
+        f"Возраст: {age} лет",
+        f"Рост: {height} см",
+        f"Вес: {weight} кг",
+        f"Уровень активности: {format_activity_display(activity_level)}"
+    ]
+    if daily_calories != 'Не рассчитана':
+        lines += [
+            f"Суточная норма калорий: **{daily_calories} ккал**",
+            "",
+            "📊 **Расчет основан на:**",
+            "• Формула Миффлина-Сан Жеора",
+            "• Ваш уровень активности",
+            ""
+        ]
+    else:
+        lines.append(f"Суточная норма калорий: {daily_calories}")
+    return "\n".join(lines)